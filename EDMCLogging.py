@@ -35,18 +35,21 @@ To utilise logging in a 'found' (third-party) plugin, include this:
     logger = logging.getLogger(f'{appname}.{plugin_name}')
 """
 
+import copy
 import inspect
 import logging
 import logging.handlers
+import queue
 from contextlib import suppress
 from fnmatch import fnmatch
 # So that any warning about accessing a protected member is only in one place.
 from sys import _getframe as getframe
 from threading import get_native_id as thread_native_id
 from traceback import print_exc
-from typing import TYPE_CHECKING, Tuple, cast
+from typing import TYPE_CHECKING, Dict, Optional, Tuple, cast
 
 import config
+from process_local import ProcessLocal
 
 # TODO: Tests:
 #
@@ -134,12 +137,15 @@ class Logger:
     logging.Logger instance.
     """
 
-    def __init__(self, logger_name: str, loglevel: int = _default_loglevel):
+    def __init__(self, logger_name: str, loglevel: int = _default_loglevel, queue_size: int = 0):
         """
         Set up a `logging.Logger` with our preferred configuration.
 
         This includes using an EDMCContextFilter to add 'class' and 'qualname'
         expansions for logging.Formatter().
+
+        If queue_size is non-zero, records are passed to the StreamHandler by a
+        background thread through a queue of that size, see DroppingQueueHandler.
         """
         self.logger = logging.getLogger(logger_name)
         # Configure the logging.Logger
@@ -148,7 +154,7 @@ class Logger:
         self.logger.setLevel(logging.TRACE)  # type: ignore
 
         # Set up filter for adding class name
-        self.logger_filter = EDMCContextFilter()
+        self.logger_filter = EDMCContextFilter(self.logger)
         self.logger.addFilter(self.logger_filter)
 
         # Our basic channel handling stdout
@@ -161,7 +167,15 @@ class Logger:
         self.logger_formatter.default_msec_format = '%s.%03d'
 
         self.logger_channel.setFormatter(self.logger_formatter)
-        self.logger.addHandler(self.logger_channel)
+
+        self.queue_handler: Optional[DroppingQueueHandler] = None
+        if queue_size > 0:
+            self.queue_handler = DroppingQueueHandler(self.logger_channel, queue_size)
+            self.queue_handler.setLevel(loglevel)
+            self.logger.addHandler(self.queue_handler)
+
+        else:
+            self.logger.addHandler(self.logger_channel)
 
     def get_logger(self) -> 'LoggerMixin':
         """
@@ -187,6 +201,8 @@ class Logger:
         :return: None
         """
         self.logger_channel.setLevel(level)
+        if self.queue_handler is not None:
+            self.queue_handler.setLevel(level)
 
     def set_console_loglevel(self, level: int) -> None:
         """
@@ -196,19 +212,152 @@ class Logger:
         :return: None
         """
         if self.logger_channel.level != logging.TRACE:  # type: ignore
-            self.logger_channel.setLevel(level)
+            self.set_channels_loglevel(level)
         else:
             logger.trace("Not changing log level because it's TRACE")  # type: ignore
 
 
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Passes records to `handler` by a background thread, so logging threads never wait on the stream.
+
+    The queue is bounded: if it's full, records are dropped and counted, and a warning about them goes
+    ahead of the next record which fits.  Unlike logging.handlers.QueueHandler, exception tracebacks are
+    formatted by the background thread too.
+
+    The thread and the queue are created lazily in every process, as threads don't survive fork.
+    """
+
+    def __init__(self, handler: logging.Handler, maxsize: int):
+        """
+        Set up the handler.
+
+        :param handler: The handler records are passed to.
+        :param maxsize: How many records can wait in the queue.
+        """
+        super().__init__(queue.Queue(maxsize))
+        self.handler = handler
+        self.maxsize = maxsize
+        self.dropped = 0  # in this process
+        self._unreported_drops = 0
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        self._process = ProcessLocal('logging-queue', on_start=self._start, at_exit=self.stop)
+
+    def _start(self) -> None:
+        self.queue = queue.Queue(self.maxsize)  # one of the parent process may be locked or have records
+        self.dropped = self._unreported_drops = 0
+        self._listener = logging.handlers.QueueListener(self.queue, self.handler, respect_handler_level=True)
+        self._listener.start()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Prepare the record to be queued.
+
+        Only the message is merged with its args, as args may change after the call, exc_info is left
+        to be formatted by the background thread.
+
+        :param record: The LogRecord to queue.
+        :return: A copy of the record.
+        """
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        """
+        Queue the record or drop it if the queue is full.
+
+        It's called under the handler's lock, so counters don't need one of their own.
+
+        :param record: The prepared LogRecord.
+        :return: None
+        """
+        self._process.start()
+
+        try:
+            if self._unreported_drops:
+                self.queue.put_nowait(self._drops_record(record))
+                self._unreported_drops = 0
+
+            self.queue.put_nowait(record)
+
+        except queue.Full:
+            self.dropped += 1
+            self._unreported_drops += 1
+
+    def _drops_record(self, record: logging.LogRecord) -> logging.LogRecord:
+        drops_record = copy.copy(record)
+        drops_record.levelno = logging.WARNING
+        drops_record.levelname = logging.getLevelName(logging.WARNING)
+        drops_record.msg = drops_record.message = f'{self._unreported_drops} log records were dropped, queue is full'
+        drops_record.exc_info = drops_record.exc_text = drops_record.stack_info = None
+        setattr(drops_record, 'qualname', f'{self.__class__.__qualname__}.enqueue')
+        setattr(drops_record, 'module', __name__)
+        return drops_record
+
+    def stop(self) -> None:
+        """
+        Stop the background thread of this process after it handles queued records.
+
+        :return: None
+        """
+        if self._listener is not None and self._process.started:
+            with suppress(queue.Full):  # the thread is a daemon one, so it won't keep the process alive
+                self._listener.stop()
+
+
 class EDMCContextFilter(logging.Filter):
     """
     Implements filtering to add extra format specifiers, and tweak others.
 
     logging.Filter sub-class to place extra attributes of the calling site
     into the record.
+
+    Call site attributes are memoized per code object (and class of its `self`/`cls`), as finding them
+    involves `inspect`.  Records which no handler is going to emit don't get the stack walked at all.
     """
 
+    # (code, owner, truthiness of owner, module_name) -> (class_name, qualname, module_name)
+    _call_sites: Dict[tuple, Tuple[str, str, str]] = {}
+
+    def __init__(self, logger: Optional[logging.Logger] = None):
+        """
+        Set up the filter.
+
+        :param logger: The logger the filter is added to, its handlers' levels are checked to skip records
+         nobody is going to emit.  If None, every record is processed.
+        """
+        super().__init__()
+        self.logger = logger
+
+    def is_emitted(self, record: logging.LogRecord) -> bool:
+        """
+        Check if any handler reachable from self.logger would emit the record, judging by handlers' levels.
+
+        :param record: The LogRecord we're "filtering"
+        :return: bool - False only if every reachable handler's level is above the record's one
+        """
+        if self.logger is None:
+            return True
+
+        current: Optional[logging.Logger] = self.logger
+        found_handlers = False
+        while current:
+            for handler in current.handlers:
+                found_handlers = True
+                if record.levelno >= handler.level:
+                    return True
+
+            if not current.propagate:
+                break
+
+            current = current.parent
+
+        # No handlers at all means logging.lastResort will be used
+        return not found_handlers
+
     def filter(self, record: logging.LogRecord) -> bool:
         """
         Attempt to set/change fields in the LogRecord.
@@ -229,7 +378,12 @@ class EDMCContextFilter(logging.Filter):
         :param record: The LogRecord we're "filtering"
         :return: bool - Always true in order for this record to be logged.
         """
-        (class_name, qualname, module_name) = self.caller_attributes(module_name=getattr(record, 'module'))
+        if not self.is_emitted(record):
+            # Nobody is going to see it, so don't walk the stack
+            (class_name, qualname, module_name) = ('<none>', record.funcName, '')
+
+        else:
+            (class_name, qualname, module_name) = self.caller_attributes(module_name=getattr(record, 'module'))
 
         # Only set if we got a useful value
         if module_name:
@@ -263,6 +417,14 @@ class EDMCContextFilter(logging.Filter):
         """
         frame = cls.find_caller_frame()
 
+        cache_key = None
+        if frame:
+            cache_key = cls.call_site_key(frame, module_name)
+            cached = cls._call_sites.get(cache_key)
+            if cached is not None:
+                del frame
+                return cached
+
         caller_qualname = caller_class_names = ''
         if frame:
             # <https://stackoverflow.com/questions/2203424/python-how-to-retrieve-class-information-from-a-frame-object#2220759>
@@ -365,6 +527,10 @@ class EDMCContextFilter(logging.Filter):
                 # https://docs.python.org/3.7/library/inspect.html#the-interpreter-stack
                 del frame
 
+        # Only remember successful lookups, so failures keep being reported
+        if cache_key is not None and caller_qualname != '' and caller_class_names != '':
+            cls._call_sites[cache_key] = (caller_class_names, caller_qualname, module_name)
+
         if caller_qualname == '':
             print('ALERT!  Something went wrong with finding caller qualname for logging!')
             caller_qualname = '<ERROR in EDMCLogging.caller_class_and_qualname() for "qualname">'
@@ -375,6 +541,28 @@ class EDMCContextFilter(logging.Filter):
 
         return caller_class_names, caller_qualname, module_name
 
+    @classmethod
+    def call_site_key(cls, frame: 'FrameType', module_name: str) -> tuple:
+        """
+        Build the key call site attributes are memoized by.
+
+        The attributes depend on the code object and, for methods, on the class of `self` (or `cls` itself),
+        as a method defined in a base class reports the class of the instance.
+
+        :param frame: The frame of the caller.
+        :param module_name: The name of the calling module.
+        :return: tuple - hashable key
+        """
+        code = frame.f_code
+        owner: object = None
+        if code.co_argcount and code.co_varnames[0] in ('self', 'cls'):
+            owner = frame.f_locals.get(code.co_varnames[0])
+
+        if owner is None:
+            return code, None, False, module_name
+
+        return code, owner if isinstance(owner, type) else type(owner), bool(owner), module_name
+
     @classmethod
     def find_caller_frame(cls):
         """
@@ -387,7 +575,7 @@ class EDMCContextFilter(logging.Filter):
         # of the frames internal to logging.
         frame: 'FrameType' = getframe(0)
         while frame:
-            if isinstance(frame.f_locals.get('self'), logging.Logger):
+            if isinstance(cls.frame_self(frame), logging.Logger):
                 frame = cast('FrameType', frame.f_back)  # Want to start on the next frame below
                 break
             frame = cast('FrameType', frame.f_back)
@@ -395,11 +583,27 @@ class EDMCContextFilter(logging.Filter):
         # that is *not* true, as it should be the call site of the logger
         # call
         while frame:
-            if not isinstance(frame.f_locals.get('self'), logging.Logger):
+            if not isinstance(cls.frame_self(frame), logging.Logger):
                 break  # We've found the frame we want
             frame = cast('FrameType', frame.f_back)
         return frame
 
+    @staticmethod
+    def frame_self(frame: 'FrameType') -> object:
+        """
+        Get `self` of a method's frame.
+
+        Checks the code object first, as building f_locals of every frame is what walking the stack costs most.
+
+        :param frame: The frame to check.
+        :return: `self` or None if it isn't a method's frame
+        """
+        code = frame.f_code
+        if code.co_argcount and code.co_varnames[0] == 'self':
+            return frame.f_locals.get('self')
+
+        return None
+
     @classmethod
     def munge_module_name(cls, frame_info: inspect.Traceback, module_name: str) -> str:
         """
@@ -443,5 +647,5 @@ loglevel = logging._nameToLevel.get(config.log_level, logging.DEBUG)  # noqa:
 
 base_logger_name = __name__
 
-edmclogger = Logger(base_logger_name, loglevel=loglevel)
+edmclogger = Logger(base_logger_name, loglevel=loglevel, queue_size=config.log_queue_size)
 logger: 'LoggerMixin' = edmclogger.get_logger()
@@ -0,0 +1,77 @@
+"""
+Local stand-in for FDEV endpoints used by the service: token (both code and refresh grants), /me and /profile,
+every response is delayed by given latency:
+    python3 benchmarks/fdev_stub.py --port 8081 --latency 0.2
+
+Point the service to it by TOKEN_URL, ME_URL and PROFILE_URL env variables, run.py does it by itself.
+"""
+
+import argparse
+import json
+import os
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TOKEN_LIFETIME = 14400
+
+
+class FDEVStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, as FDEV does
+    latency = 0.0
+
+    def _reply(self, body: dict, status: int = 200) -> None:
+        time.sleep(self.latency)
+        encoded = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def _access_token(self) -> str:
+        return self.headers.get('Authorization', '').removeprefix('Bearer ')
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get('Content-Length', 0))
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode('utf-8'))
+        if urllib.parse.urlparse(self.path).path != '/token' \
+                or form.get('grant_type', [''])[0] not in ('authorization_code', 'refresh_token'):
+            self._reply({'message': 'Bad request'}, 400)
+            return
+
+        self._reply({
+            'access_token': os.urandom(16).hex(),
+            'refresh_token': os.urandom(16).hex(),
+            'expires_in': TOKEN_LIFETIME,
+            'token_type': 'Bearer'
+        })
+
+    def do_GET(self) -> None:
+        path = urllib.parse.urlparse(self.path).path
+        if path == '/me':
+            self._reply({'customer_id': 'stub-' + self._access_token()[:12]})
+
+        elif path == '/profile':
+            self._reply({'commander': {'name': 'Stub' + self._access_token()[:8]}})
+
+        else:
+            self._reply({'message': 'Not found'}, 404)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+def serve(port: int, latency: float) -> None:
+    FDEVStubHandler.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', port), FDEVStubHandler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for FDEV endpoints')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds to delay every response')
+    args = parser.parse_args()
+    serve(args.port, args.latency)
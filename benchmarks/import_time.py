@@ -0,0 +1,89 @@
+"""
+Import time budget check, workers import the app on every (re)spawn with lazy-apps and ASGI servers:
+    python3 benchmarks/import_time.py --runs 5 --top 10
+
+Imports every module of --budget in a fresh interpreter --runs times and compares the best time with the budget
+in milliseconds. Also checks that importing doesn't open the DB, as it has to be opened in every worker after fork.
+Exits with 1 if any check fails, so it can be run in CI.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_BUDGETS = ('config=25', 'capi=250', 'web=400')
+
+MEASURE = """
+import time
+started = time.perf_counter()
+import {module}
+print(time.perf_counter() - started)
+"""
+
+
+def run_python(code: str, env: dict, importtime: bool = False) -> subprocess.CompletedProcess:
+    args = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', code]
+    return subprocess.run(args, env=env, cwd=PROJECT_DIR, capture_output=True, text=True, check=True)
+
+
+def measure(module: str, env: dict, runs: int) -> float:
+    """
+    :return: best import time of `runs` in seconds
+    """
+
+    return min(float(run_python(MEASURE.format(module=module), env).stdout.split()[-1]) for _ in range(runs))
+
+
+def top_imports(module: str, env: dict, top: int) -> list[tuple[int, str]]:
+    """
+    :return: [(self time in microseconds, module name)] of the slowest imports
+    """
+
+    stderr = run_python(f'import {module}', env, importtime=True).stderr
+    imports = list()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        self_us, _, name = line[len('import time:'):].split('|')
+        imports.append((int(self_us), name.strip()))
+
+    return sorted(imports, reverse=True)[:top]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget', nargs='+', default=list(DEFAULT_BUDGETS), help='module=milliseconds')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='slowest imports to show for modules over budget')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='capi-import-time-')
+    db_location = os.path.join(tmp_dir, 'companion-api.sqlite')
+    env = dict(os.environ, client_id='bench', access_key='bench', db_location=db_location,
+               metrics_dir=os.path.join(tmp_dir, 'metrics'))
+
+    failed = False
+    for budget in args.budget:
+        module, milliseconds = budget.split('=')
+        took = measure(module, env, args.runs) * 1000
+        over = took > float(milliseconds)
+        failed |= over
+        print(f'{module:<10} {took:8.1f} ms, budget {float(milliseconds):8.1f} ms{" OVER" if over else ""}')
+        if over:
+            for self_us, name in top_imports(module, env, args.top):
+                print(f'    {self_us / 1000:8.1f} ms {name}')
+
+    if os.path.exists(db_location):
+        print(f'DB was opened at import, it must be opened lazily after fork: {db_location}')
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
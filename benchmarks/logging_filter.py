@@ -0,0 +1,50 @@
+"""
+Micro-benchmark of EDMCContextFilter cost per log record:
+    python3 benchmarks/logging_filter.py --records 20000
+
+Compares call site lookup without memoization (as it was before), with it, and for records below handlers'
+level, which skip the lookup.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('client_id', 'benchmark')
+os.environ['LOG_LEVEL'] = 'INFO'
+
+import EDMCLogging  # noqa: E402, after env is set
+
+
+class Caller:
+    def method(self, records: int, clear_cache: bool, level: int) -> None:
+        for _ in range(records):
+            if clear_cache:
+                EDMCLogging.EDMCContextFilter._call_sites.clear()
+
+            logger.log(level, 'Benchmark record %s', 'argument')
+
+
+def per_record_us(records: int, clear_cache: bool, level: int) -> float:
+    caller = Caller()
+    started = time.perf_counter()
+    caller.method(records, clear_cache, level)
+    return (time.perf_counter() - started) / records * 1_000_000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='EDMCContextFilter cost per record')
+    parser.add_argument('--records', type=int, default=20000)
+    args = parser.parse_args()
+
+    logger = EDMCLogging.get_main_logger()
+    # measure filtering, not writing to the terminal
+    EDMCLogging.edmclogger.get_streamhandler().setStream(open(os.devnull, 'w'))
+
+    print(f'not memoized:         {per_record_us(args.records, True, logging.INFO):8.2f} us/record')
+    print(f'memoized:             {per_record_us(args.records, False, logging.INFO):8.2f} us/record')
+    print(f'below handlers level: {per_record_us(args.records, False, logging.DEBUG):8.2f} us/record')
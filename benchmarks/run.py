@@ -0,0 +1,282 @@
+"""
+HTTP load benchmark of web.application against local FDEV stand-in (fdev_stub.py):
+    python3 benchmarks/run.py --users 100000 --expired 0.05 --latency 0.2 --concurrency 32 --duration 30
+
+Seeds fresh DB with --users fake users, starts the stand-in and the service (benchmarks/serve.py, or uwsgi with
+--server uwsgi) in subprocesses, drives every route by --concurrency threads for --duration seconds and
+reports requests per second and p50/p99 latency per route. Results are saved to benchmarks/results/ as JSON,
+so releases can be compared. Service config can be tweaked with --env name=value.
+
+DELETE routes and maintenance tools aren't driven, as they change the dataset.
+"""
+
+import argparse
+import datetime
+import http.client
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BENCHMARKS_DIR)
+ACCESS_KEY = 'benchmark'
+
+# route -> weight in the mix
+ROUTES = {
+    '/users/by-fid/{fid}': 30,
+    '/users/by-nickname/{nickname}': 15,
+    '/users/by-state/{state}': 15,
+    '/users/{state}': 5,
+    '/users/bulk': 5,
+    '/users': 5,
+    '/random_token': 10,
+    '/authorize': 2,
+    '/fdev-redirect': 2,
+    '/tools/cache-stats': 1,
+    '/metrics': 1
+}
+
+
+def request(connection: http.client.HTTPConnection, method: str, path: str, body: dict = None) -> tuple[int, bytes]:
+    headers = {'AUTH': ACCESS_KEY}
+    encoded_body = None
+    if body is not None:
+        encoded_body = json.dumps(body).encode('utf-8')
+        headers['Content-Type'] = 'application/json'
+
+    connection.request(method, path, body=encoded_body, headers=headers)
+    response = connection.getresponse()
+    return response.status, response.read()
+
+
+def drive(connection: http.client.HTTPConnection, route: str, users: int) -> int:
+    """
+    Make one request to the route for random user
+
+    :return: response status
+    """
+
+    from seed import user_state, user_fid, user_nickname
+
+    i = random.randrange(users)
+    if route == '/users/by-fid/{fid}':
+        return request(connection, 'GET', f'/users/by-fid/{user_fid(i)}')[0]
+
+    if route == '/users/by-nickname/{nickname}':
+        return request(connection, 'GET', f'/users/by-nickname/{user_nickname(i)}')[0]
+
+    if route == '/users/by-state/{state}':
+        return request(connection, 'GET', f'/users/by-state/{user_state(i)}')[0]
+
+    if route == '/users/{state}':
+        return request(connection, 'GET', f'/users/{user_state(i)}')[0]
+
+    if route == '/users/bulk':
+        fids = [user_fid(random.randrange(users)) for _ in range(20)]
+        return request(connection, 'POST', '/users/bulk', {'fids': fids})[0]
+
+    if route == '/users':
+        return request(connection, 'GET', f'/users?limit=100&after={user_state(i)}')[0]
+
+    if route == '/random_token':
+        return request(connection, 'GET', '/random_token?least_used=true')[0]
+
+    if route in ('/authorize', '/fdev-redirect'):
+        status, body = request(connection, 'GET', '/authorize')
+        if route == '/authorize' or status != 200:
+            return status
+
+        state = re.search(r'state=([^&"]+)', body.decode('utf-8')).group(1)
+        return request(connection, 'GET', f'/fdev-redirect?code=benchmark&state={urllib.parse.quote(state)}')[0]
+
+    return request(connection, 'GET', route)[0]
+
+
+def worker(port: int, users: int, deadline: float, results: dict, lock: threading.Lock) -> None:
+    routes = list(ROUTES.keys())
+    weights = list(ROUTES.values())
+    latencies = {route: list() for route in routes}
+    errors = {route: 0 for route in routes}
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+
+    while time.monotonic() < deadline:
+        route = random.choices(routes, weights)[0]
+        started = time.perf_counter()
+        try:
+            status = drive(connection, route, users)
+
+        except (OSError, http.client.HTTPException):
+            status = None
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+
+        latencies[route].append(time.perf_counter() - started)
+        if status is None or status >= 400:
+            errors[route] += 1
+
+    with lock:
+        for route in routes:
+            results['latencies'][route].extend(latencies[route])
+            results['errors'][route] += errors[route]
+
+
+def percentile(sorted_values: list[float], share: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(share * len(sorted_values)))]
+
+
+def summarize(latencies: list[float], errors: int, duration: float) -> dict:
+    if len(latencies) == 0:
+        return {'requests': 0, 'errors': errors, 'rps': 0, 'p50_ms': None, 'p99_ms': None}
+
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / duration, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2)
+    }
+
+
+def wait_for_port(port: int, process: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Process {process.args!r} exited with {process.returncode}')
+
+        try:
+            http.client.HTTPConnection('127.0.0.1', port, timeout=1).connect()
+            return
+
+        except OSError:
+            time.sleep(0.2)
+
+    raise TimeoutError(f'Nothing listens on {port} after {timeout}s')
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=PROJECT_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='HTTP load benchmark of web.application')
+    parser.add_argument('--users', type=int, default=10000, help='users to seed DB with')
+    parser.add_argument('--expired', type=float, default=0.05, help='share of users with expired tokens')
+    parser.add_argument('--latency', type=float, default=0.2, help='FDEV stand-in latency, seconds')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--server', choices=('wsgiref', 'uwsgi'), default='wsgiref')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--stub-port', type=int, default=18081)
+    parser.add_argument('--env', action='append', default=list(), help='name=value for service config')
+    parser.add_argument('--output', help='results file, benchmarks/results/<time>.json by default')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='capi-benchmark-')
+    stub_url = f'http://127.0.0.1:{args.stub_port}'
+    env = dict(os.environ)
+    env.update({
+        'client_id': 'benchmark',
+        'access_key': ACCESS_KEY,
+        'db_location': os.path.join(work_dir, 'benchmark.sqlite'),
+        'metrics_dir': os.path.join(work_dir, 'metrics'),
+        'LOG_LEVEL': 'WARNING',
+        'TOKEN_URL': stub_url + '/token',
+        'ME_URL': stub_url + '/me',
+        'PROFILE_URL': stub_url + '/profile'
+    })
+    env.update(item.split('=', 1) for item in args.env)
+    os.environ.update(env)
+
+    sys.path.insert(0, PROJECT_DIR)
+    import seed  # noqa, after env is set
+
+    print(f'Seeding {args.users} users to {env["db_location"]}', flush=True)
+    seed.seed(env['db_location'], args.users, args.expired)
+
+    if args.server == 'uwsgi':
+        server_command = [
+            'uwsgi', '--http-socket', f'127.0.0.1:{args.port}', '--wsgi-file', os.path.join(PROJECT_DIR, 'web.py'),
+            '--master', '--enable-threads', '--processes', str(os.cpu_count()), '--threads', str(os.cpu_count()),
+            '--chdir', PROJECT_DIR, '--disable-logging'
+        ]
+
+    else:
+        server_command = [sys.executable, os.path.join(BENCHMARKS_DIR, 'serve.py'), '--port', str(args.port)]
+
+    stub_command = [
+        sys.executable, os.path.join(BENCHMARKS_DIR, 'fdev_stub.py'),
+        '--port', str(args.stub_port), '--latency', str(args.latency)
+    ]
+    processes = [subprocess.Popen(stub_command, env=env), subprocess.Popen(server_command, env=env)]
+    try:
+        wait_for_port(args.stub_port, processes[0])
+        wait_for_port(args.port, processes[1])
+
+        print(f'Driving for {args.duration}s by {args.concurrency} threads', flush=True)
+        results = {'latencies': {route: list() for route in ROUTES}, 'errors': {route: 0 for route in ROUTES}}
+        lock = threading.Lock()
+        deadline = time.monotonic() + args.duration
+        started = time.monotonic()
+        threads = [
+            threading.Thread(target=worker, args=(args.port, args.users, deadline, results, lock))
+            for _ in range(args.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        duration = time.monotonic() - started
+
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    all_latencies = [latency for latencies in results['latencies'].values() for latency in latencies]
+    report = {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'git_revision': git_revision(),
+        'python': sys.version,
+        'params': vars(args),
+        'total': summarize(all_latencies, sum(results['errors'].values()), duration),
+        'routes': {
+            route: summarize(results['latencies'][route], results['errors'][route], duration) for route in ROUTES
+        }
+    }
+
+    print(f'{"route":<32} {"requests":>9} {"errors":>7} {"rps":>9} {"p50 ms":>9} {"p99 ms":>9}')
+    for route, summary in list(report['routes'].items()) + [('total', report['total'])]:
+        print(f'{route:<32} {summary["requests"]:>9} {summary["errors"]:>7} {summary["rps"]:>9} '
+              f'{summary["p50_ms"]!s:>9} {summary["p99_ms"]!s:>9}')
+
+    output = args.output
+    if output is None:
+        os.makedirs(os.path.join(BENCHMARKS_DIR, 'results'), exist_ok=True)
+        output = os.path.join(
+            BENCHMARKS_DIR, 'results', datetime.datetime.now().strftime('%Y-%m-%d-%H%M%S') + '.json'
+        )
+
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+
+    print(f'Results are saved to {output}')
+
+
+if __name__ == '__main__':
+    main()
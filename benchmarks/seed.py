@@ -0,0 +1,73 @@
+"""
+Fills DB with N fake users, much faster than by logins, env has to be set as for the service:
+    db_location=bench.sqlite python3 benchmarks/seed.py --users 100000 --expired 0.1
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BATCH_SIZE = 10000
+
+insert_user = """insert into authorizations 
+    (code_verifier, state, timestamp_init, code, access_token, refresh_token, expires_in, timestamp_got_expires_in, 
+    nickname, refresh_tries, usages, fid) 
+    values 
+    ('verifier', :state, :now, 'code', :access_token, 'refresh', :expires_in, :timestamp_got_expires_in, 
+    :nickname, 0, 0, :fid);"""
+
+
+def user_state(i: int) -> str:
+    return f'bench-state-{i}'
+
+
+def user_fid(i: int) -> str:
+    return f'F{i}'
+
+
+def user_nickname(i: int) -> str:
+    return f'Bench{i}'
+
+
+def seed(db_location: str, users: int, expired_share: float) -> None:
+    """
+    :param db_location:
+    :param users: amount of users to create
+    :param expired_share: share of users which tokens are expired, so they get refreshed on first request
+    :return:
+    """
+
+    from capi import model  # noqa, env has to be set by the moment
+
+    db = model.Model(db_location).db  # applies migrations
+    now = int(time.time())
+    expired_every = round(1 / expired_share) if expired_share > 0 else 0
+
+    with db:
+        db.execute('delete from authorizations;')
+        for batch_start in range(0, users, BATCH_SIZE):
+            db.executemany(insert_user, (
+                {
+                    'state': user_state(i),
+                    'now': now,
+                    'access_token': f'access-{i}',
+                    'expires_in': 14400,
+                    'timestamp_got_expires_in': now - 86400 if expired_every and i % expired_every == 0 else now,
+                    'nickname': user_nickname(i),
+                    'fid': user_fid(i)
+                } for i in range(batch_start, min(batch_start + BATCH_SIZE, users))
+            ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fill DB with fake users')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--expired', type=float, default=0.0, help='share of users with expired tokens')
+    args = parser.parse_args()
+
+    import config  # noqa
+
+    seed(config.db_location, args.users, args.expired)
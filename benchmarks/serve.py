@@ -0,0 +1,34 @@
+"""
+Serves web.application by threaded wsgiref server for benchmarks when uwsgi isn't at hand:
+    python3 benchmarks/serve.py --port 8080
+"""
+
+import argparse
+import os
+import socketserver
+import sys
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve web.application')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    import web  # noqa, after sys.path is set
+
+    make_server(
+        '127.0.0.1', args.port, web.application, server_class=ThreadingWSGIServer, handler_class=QuietHandler
+    ).serve_forever()
@@ -1,210 +1,576 @@
-import requests
-
-from . import model
-from . import utils
-from . import exceptions
-
-import base64
-import os
-import time
-from typing import Union
-
-import config
-from EDMCLogging import get_main_logger
-
-logger = get_main_logger()
-
-
-class CAPIAuthorizer:
-    def __init__(self, _model: model.Model):
-        self.model: model.Model = _model
-
-    def auth_init(self) -> str:
-        """
-        Generates initial url for fdev auth
-
-        :return:
-        """
-
-        code_verifier = base64.urlsafe_b64encode(os.urandom(32))
-        code_challenge = utils.generate_challenge(code_verifier)
-        state_string = base64.urlsafe_b64encode(os.urandom(32)).decode("utf-8")
-
-        self.model.auth_init(code_verifier.decode('utf-8'), state_string)
-
-        redirect_user_to_fdev = f"{config.AUTH_URL}?" \
-                                f"audience=all&" \
-                                f"scope=auth%20capi&" \
-                                f"response_type=code&" \
-                                f"client_id={config.CLIENT_ID}&" \
-                                f"code_challenge={code_challenge}&" \
-                                f"code_challenge_method=S256&" \
-                                f"state={state_string}&" \
-                                f"redirect_uri={config.REDIRECT_URL}"
-
-        return redirect_user_to_fdev
-
-    def fdev_callback(self, code: str, state: str) -> dict[str, str]:
-        if type(code) is not str or type(state) != str:
-            raise TypeError('code and state must be strings')
-
-        code_verifier = self.model.get_verifier(state)
-
-        self.model.set_code(code, state)
-
-        token_request = utils.get_tokens_request(code, code_verifier)
-
-        try:
-            token_request.raise_for_status()
-
-        except Exception as e:
-            logger.exception(
-                f'token_request failed. Status: {token_request.status_code!r}, text: {token_request.text!r}',
-                exc_info=e
-            )
-
-            # self.model.delete_row(state)
-
-            raise e
-
-        tokens = token_request.json()
-
-        access_token = tokens["access_token"]
-        refresh_token = tokens["refresh_token"]
-        expires_in = tokens["expires_in"]
-        timestamp_got_expires_in = int(time.time())
-
-        self.model.set_tokens(access_token, refresh_token, expires_in, timestamp_got_expires_in, state)
-
-        nickname = utils.get_nickname(access_token)
-        self.model.set_nickname(nickname, state)
-        if nickname is None:
-            logger.warning(f"Couldn't get or set nickname for state: {state!r}")  # msg inform: no nickname
-
-        fid = utils.get_fid(access_token)
-        if fid is None:
-            logger.error(f"Couldn't get FID for state: {state!r}")
-            raise exceptions.NoFID(f'No FID for {state!r}')
-
-        msg = {'status': 'ok', 'description': '', 'state': ''}
-
-        if not self.model.set_fid(fid, state):
-            msg['description'] = 'Tokens updated'
-
-        else:
-            msg['description'] = 'Tokens saved'
-
-        msg['state'] = self.model.get_state_by_fid(fid)
-
-        return msg
-
-    def get_token_by_state(self, state: str) -> Union[dict, None]:
-        try:
-            self.refresh_by_state(state)
-
-        except exceptions.CAPIException:
-            return None
-
-        row = self.model.get_token_for_user(state)
-
-        if row is None:
-            return None
-
-        row['expires_over'] = int(row['expires_on']) - int(time.time())
-
-        return row
-
-    def refresh_by_state(self, state: str, force_refresh=False, failure_tolerance=config.default_failure_tolerance) -> dict:
-        """
-
-        :param state:
-        :param force_refresh: if we should update token when its time hasn't come
-        :param failure_tolerance: if we shouldn't remove row in case of update's failure
-        :return:
-        """
-
-        msg = {'status': '', 'description': '', 'state': ''}
-        row = self.model.get_row(state)
-
-        if row is None:
-            # No such state in DB
-            msg['status'] = 'error'
-            msg['description'] = 'No such state in DB'
-            raise exceptions.RefreshFail(msg['description'], msg['status'], state)
-
-        msg['state'] = state
-
-        if int(time.time()) < int(row['timestamp_got_expires_in']) + int(row['expires_in']) - 400 and not force_refresh:
-            # current time < when we got token + token lifetime - 400, 400 is need just to refresh token on 400 secs
-            # earlier than lifetime stated by FDEV, for safe
-            msg['status'] = 'ok'
-            msg['description'] = "Didn't refresh since it isn't required"
-
-            return msg  # token isn't expired and we don't force updating
-
-        try:
-            refresh_request = utils.refresh_request(row['refresh_token'])
-            if refresh_request.status_code == 418:  # Server's maintenance
-                logger.warning(f'FDEV maintenance 418, text: {refresh_request.text!r}')
-                msg['status'] = 'error'
-                msg['description'] = 'FDEV on maintenance'
-                raise exceptions.RefreshFail(msg['message'], msg['status'], state)
-
-            refresh_request.raise_for_status()
-
-            tokens = refresh_request.json()
-            self.model.set_tokens(
-                access_token=tokens["access_token"],
-                refresh_token=tokens["refresh_token"],
-                expires_in=tokens["expires_in"],
-                timestamp_got_expires_in=int(time.time()),
-                state=state
-            )
-            msg['status'] = 'ok'
-            msg['description'] = 'Token were successfully updated'
-            return msg
-
-        except requests.ConnectionError as e:
-            logger.warning(f'Connection problem on refresh for {state!r}', exc_info=e)
-            msg['status'] = 'error'
-            msg['description'] = 'Connection Error'
-            raise exceptions.RefreshFail(msg['description'], msg['status'], state)
-
-        except Exception as e:
-            # probably here something don't work
-            text = ''
-            try:
-                text = refresh_request.text
-
-            except Exception as e1:
-                text = f"can't get text because {e1}"
-
-            logger.warning(
-                f'Fail on refreshing token for {state!r}, row:{row!r}, text: {text}', exc_info=e)
-            msg['status'] = 'error'
-
-            self.model.increment_refresh_tries(state)
-
-            if not failure_tolerance:
-                if row['refresh_tries'] >= 5:  # hardcoded limit
-                    msg['description'] = "Refresh failed. You were removed from DB due to refresh rate limitings"
-                    self.model.delete_row(state)
-                    raise exceptions.RefreshFail(msg['description'], msg['status'], state)
-
-            msg['description'] = "Refresh failed. Try later"
-            raise exceptions.RefreshFail(msg['description'], msg['status'], state)
-
-    def delete_by_state(self, state: str) -> None:
-        self.model.delete_row(state)
-
-    def list_all_valid_users(self) -> list[dict]:
-        return self.model.list_all_valid_records()
-
-    def cleanup_orphans(self) -> None:
-        self.model.cleanup_orphans_records()
-
-    def list_all_records(self) -> list[dict]:
-        return self.model.list_all_records()
-
-
-capi_authorizer = CAPIAuthorizer(model.Model(config.db_location))
+import requests
+
+from . import model
+from . import utils
+from . import exceptions
+from .circuit_breaker import CircuitBreaker
+from .metrics import metrics, REFRESHES
+
+import base64
+import concurrent.futures
+import contextlib
+import os
+import threading
+import time
+from typing import Iterator, Union
+
+import config
+from EDMCLogging import get_main_logger
+
+logger = get_main_logger()
+
+
+class CAPIAuthorizer:
+    def __init__(self, _model: model.Model):
+        self.model: model.Model = _model
+        # state -> [lock, amount of threads using it], for refreshes single-flight within process
+        self._refresh_flights: dict[str, list] = dict()
+        self._refresh_flights_lock = threading.Lock()
+        self.breaker = CircuitBreaker(config.circuit_failure_threshold, config.circuit_cooldown)
+        # for refreshes of bulk requests
+        self._bulk_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.bulk_refresh_workers,
+            thread_name_prefix='bulk-refresh'
+        )
+        # for /me and /profile requests on fdev callback, separate pools, so slow optional /profile requests
+        # can't hold up required /me ones
+        self._fid_lookups = concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.callback_lookup_workers,
+            thread_name_prefix='fdev-fid-lookups'
+        )
+        self._nickname_lookups = concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.callback_lookup_workers,
+            thread_name_prefix='fdev-nickname-lookups'
+        )
+
+    def auth_init(self) -> str:
+        """
+        Generates initial url for fdev auth
+
+        :return:
+        """
+
+        code_verifier = base64.urlsafe_b64encode(os.urandom(32))
+        code_challenge = utils.generate_challenge(code_verifier)
+        state_string = base64.urlsafe_b64encode(os.urandom(32)).decode("utf-8")
+
+        self.model.auth_init(code_verifier.decode('utf-8'), state_string)
+
+        redirect_user_to_fdev = f"{config.AUTH_URL}?" \
+                                f"audience=all&" \
+                                f"scope=auth%20capi&" \
+                                f"response_type=code&" \
+                                f"client_id={config.CLIENT_ID}&" \
+                                f"code_challenge={code_challenge}&" \
+                                f"code_challenge_method=S256&" \
+                                f"state={state_string}&" \
+                                f"redirect_uri={config.REDIRECT_URL}"
+
+        return redirect_user_to_fdev
+
+    def fdev_callback(self, code: str, state: str) -> dict[str, str]:
+        if type(code) is not str or type(state) != str:
+            raise TypeError('code and state must be strings')
+
+        code_verifier = self.model.get_verifier(state)
+
+        token_request = utils.get_tokens_request(code, code_verifier)
+
+        try:
+            token_request.raise_for_status()
+
+        except Exception as e:
+            logger.exception(
+                f'token_request failed. Status: {token_request.status_code!r}, text: {token_request.text!r}',
+                exc_info=e
+            )
+
+            # self.model.delete_row(state)
+
+            raise e
+
+        tokens = token_request.json()
+
+        access_token = tokens["access_token"]
+        refresh_token = tokens["refresh_token"]
+        expires_in = tokens["expires_in"]
+        timestamp_got_expires_in = int(time.time())
+
+        # companion /profile is often slow, so we do both lookups at once and, once we have fid, wait for nickname
+        # no longer than callback_nickname_grace
+        deadline = time.monotonic() + config.callback_lookup_timeout
+        fid_future = self._fid_lookups.submit(utils.get_fid, access_token)
+        nickname_future = self._nickname_lookups.submit(utils.get_nickname, access_token)
+
+        try:
+            fid = fid_future.result(timeout=max(0.0, deadline - time.monotonic()))
+
+        except concurrent.futures.TimeoutError:
+            fid = None
+
+        if fid is None:
+            logger.error(f"Couldn't get FID for state: {state!r}")
+            raise exceptions.NoFID(f'No FID for {state!r}')
+
+        nickname_is_late = False
+        try:
+            nickname = nickname_future.result(
+                timeout=max(0.0, min(deadline - time.monotonic(), config.callback_nickname_grace))
+            )
+            if nickname is None:
+                logger.warning(f"Couldn't get or set nickname for state: {state!r}")  # msg inform: no nickname
+
+        except concurrent.futures.TimeoutError:
+            nickname = None
+            nickname_is_late = True
+
+        msg = {'status': 'ok', 'description': '', 'state': ''}
+
+        is_new, msg['state'] = self.model.save_login(
+            code=code,
+            access_token=access_token,
+            refresh_token=refresh_token,
+            expires_in=expires_in,
+            timestamp_got_expires_in=timestamp_got_expires_in,
+            nickname=nickname,
+            fid=fid,
+            state=state
+        )
+
+        if is_new:
+            msg['description'] = 'Tokens saved'
+
+        else:
+            msg['description'] = 'Tokens updated'
+
+        if nickname_is_late:
+            # only after save_login, so the row with the fid exists when nickname arrives
+            logger.info(f'Nickname lookup for {fid!r} is slow, it will be set later')
+            nickname_future.add_done_callback(lambda future: self._set_late_nickname(future, fid))
+
+        return msg
+
+    def _set_late_nickname(self, nickname_future: concurrent.futures.Future, fid: str) -> None:
+        nickname = nickname_future.result()  # get_nickname doesn't raise
+        if nickname is None:
+            logger.warning(f"Couldn't get or set nickname for fid: {fid!r}")
+            return
+
+        try:
+            self.model.set_nickname_by_fid(nickname, fid)
+
+        except Exception as e:
+            logger.warning(f"Couldn't set late nickname for fid: {fid!r}", exc_info=e)
+
+    def get_token_by_state(self, state: str) -> Union[dict, None]:
+        """
+        Token for the state, refreshed if it's due refresh
+
+        :param state:
+        :raises exceptions.UpstreamUnavailable: if the state exists, but its token has expired and FDEV can't refresh
+        it now
+        :return: None if there is no such state or the refresh failed
+        """
+
+        row = self.model.get_fresh_token_for_user(state, config.token_refresh_margin)
+
+        if row is None and self.breaker.is_open:
+            # FDEV is down, better to give token which is due refresh than nothing
+            row = self.model.get_fresh_token_for_user(state, 0)
+
+        if row is None:
+            # No such state or token has to be refreshed
+            try:
+                self.refresh_by_state(state)
+                row = self.model.get_token_for_user(state)
+
+            except exceptions.UpstreamUnavailable:
+                # FDEV can't refresh it now, but the token may be still valid, e.g. it's just due refresh
+                row = self.model.get_fresh_token_for_user(state, 0)
+                if row is None:
+                    raise
+
+            except exceptions.CAPIException:
+                return None
+
+            if row is None:
+                return None
+
+        row['expires_over'] = int(row['expires_on']) - int(time.time())
+
+        return row
+
+    def peek_token_by_state(self, state: str) -> Union[dict, None]:
+        """
+        Token if it's fresh, doesn't refresh it and doesn't count usage
+
+        :param state:
+        :return: token without expires_over, None if there is no such state or token has to be refreshed
+        """
+
+        return self.model.get_fresh_token_for_user(state, config.token_refresh_margin, count_usage=False)
+
+    def get_tokens_by_states(self, states: list[str]) -> dict[str, Union[dict, None]]:
+        """
+        Bulk version of get_token_by_state, tokens which need refresh get refreshed in parallel
+
+        :param states:
+        :return: {state: token or None}
+        """
+
+        tokens: dict[str, Union[dict, None]] = dict()
+        to_refresh: list[str] = list()
+        for state in set(states):
+            token = self.model.get_fresh_token_for_user(state, config.token_refresh_margin)
+            if token is None:
+                to_refresh.append(state)
+
+            else:
+                token['expires_over'] = int(token['expires_on']) - int(time.time())
+                tokens[state] = token
+
+        tokens.update(zip(to_refresh, self._bulk_executor.map(self._get_token_or_none, to_refresh)))
+
+        return tokens
+
+    def _get_token_or_none(self, state: str) -> Union[dict, None]:
+        """
+        get_token_by_state which gives None if FDEV is unavailable, for bulk and random tokens
+        """
+
+        try:
+            return self.get_token_by_state(state)
+
+        except exceptions.UpstreamUnavailable:
+            return None
+
+    def refresh_by_state(self, state: str, force_refresh=False, failure_tolerance=config.default_failure_tolerance,
+                         refresh_margin: int = config.token_refresh_margin) -> dict:
+        """
+
+        :param state:
+        :param force_refresh: if we should update token when its time hasn't come
+        :param failure_tolerance: if we shouldn't remove row in case of update's failure
+        :param refresh_margin: how many seconds before expiration token is considered as due to refresh
+        :return:
+        """
+
+        try:
+            msg = self._refresh_by_state(state, force_refresh, failure_tolerance, refresh_margin)
+
+        except exceptions.RefreshFail as e:
+            metrics.inc(REFRESHES, {'status': e.status, 'description': e.message})
+            raise
+
+        metrics.inc(REFRESHES, {'status': msg['status'], 'description': msg['description']})
+        return msg
+
+    def _refresh_by_state(self, state: str, force_refresh: bool, failure_tolerance: bool, refresh_margin: int) -> dict:
+        msg = {'status': '', 'description': '', 'state': ''}
+        row = self.model.get_row(state)
+
+        if not self._is_refresh_needed(row, state, msg, force_refresh, refresh_margin):
+            return msg
+
+        if self.breaker.is_open:
+            self._on_circuit_open(state, msg)
+
+        with self._refresh_flight(state) as acquired:
+            fresh_row = self._get_row_after_wait(acquired, row, state, msg)
+            if fresh_row is None:
+                return msg
+
+            return self._refresh_row(fresh_row, msg, failure_tolerance)
+
+    @staticmethod
+    def _is_refresh_needed(row: Union[dict, None], state: str, msg: dict, force_refresh: bool,
+                           refresh_margin: int) -> bool:
+        """
+        Part of refresh_by_state, fills msg if refresh isn't needed
+
+        :return: True if the row has to be refreshed
+        """
+
+        if row is None:
+            # No such state in DB
+            msg['status'] = 'error'
+            msg['description'] = 'No such state in DB'
+            raise exceptions.RefreshFail(msg['description'], msg['status'], state)
+
+        msg['state'] = state
+
+        if int(time.time()) < int(row['timestamp_got_expires_in']) + int(row['expires_in']) - refresh_margin \
+                and not force_refresh:
+            # current time < when we got token + token lifetime - margin, margin is need just to refresh token on
+            # margin secs earlier than lifetime stated by FDEV, for safe
+            msg['status'] = 'ok'
+            msg['description'] = "Didn't refresh since it isn't required"
+
+            return False  # token isn't expired and we don't force updating
+
+        return True
+
+    def _get_row_after_wait(self, acquired: bool, row: dict, state: str, msg: dict) -> Union[dict, None]:
+        """
+        Part of refresh_by_state, somebody could refresh or fail to refresh the token while we were waiting
+        for our turn
+
+        :param acquired: if we got our turn to refresh
+        :param row: row as it was before waiting
+        :return: row to refresh, None if it was refreshed concurrently (msg is filled then)
+        """
+
+        if not acquired:
+            msg['status'] = 'error'
+            msg['description'] = 'Refresh is in progress. Try later'
+            raise exceptions.UpstreamUnavailable(msg['description'], msg['status'], state)
+
+        fresh_row = self.model.get_row(state)
+        if fresh_row is None:
+            msg['status'] = 'error'
+            msg['description'] = 'No such state in DB'
+            raise exceptions.RefreshFail(msg['description'], msg['status'], state)
+
+        if fresh_row['access_token'] != row['access_token'] \
+                or fresh_row['timestamp_got_expires_in'] != row['timestamp_got_expires_in']:
+            msg['status'] = 'ok'
+            msg['description'] = 'Token were updated by concurrent refresh'
+            return None
+
+        if fresh_row['refresh_tries'] > row['refresh_tries']:
+            msg['status'] = 'error'
+            msg['description'] = 'Refresh failed. Try later'
+            raise exceptions.RefreshFail(msg['description'], msg['status'], state)
+
+        return fresh_row
+
+    @contextlib.contextmanager
+    def _refresh_flight(self, state: str) -> Iterator[bool]:
+        """
+        Makes refresh of a state single-flight across threads (by per state lock) and across processes
+        (by lease in refresh_locks table)
+
+        :param state:
+        :return: context manager which yields True if we are the one who should refresh, False if we gave up waiting
+        """
+
+        deadline = time.monotonic() + config.refresh_wait_timeout
+
+        with self._refresh_flights_lock:
+            flight = self._refresh_flights.setdefault(state, [threading.Lock(), 0])
+            flight[1] += 1
+
+        lock: threading.Lock = flight[0]
+        locked_until = None
+        try:
+            if lock.acquire(timeout=config.refresh_wait_timeout):
+                try:
+                    while True:
+                        locked_until = self.model.acquire_refresh_lock(state, config.refresh_lock_ttl)
+                        if locked_until is not None or time.monotonic() >= deadline:
+                            break
+
+                        time.sleep(0.1)  # another process refreshes this state
+
+                    yield locked_until is not None
+
+                finally:
+                    if locked_until is not None:
+                        self.model.release_refresh_lock(state, locked_until)
+
+                    lock.release()
+
+            else:
+                yield False
+
+        finally:
+            with self._refresh_flights_lock:
+                flight[1] -= 1
+                if flight[1] == 0:
+                    del self._refresh_flights[state]
+
+    def _refresh_row(self, row: dict, msg: dict, failure_tolerance: bool) -> dict:
+        self._check_circuit(row['state'], msg)
+        try:
+            refresh_request = utils.refresh_request(row['refresh_token'])
+
+        except requests.RequestException as e:
+            # truncated or broken responses are as much FDEV's fault as connection errors
+            self._on_refresh_connection_error(row['state'], msg, e)
+
+        except exceptions.UpstreamThrottled as e:
+            self._on_refresh_throttled(row['state'], msg, e)
+
+        except Exception as e:
+            self._on_refresh_error(row['state'], msg, e)
+
+        except BaseException:
+            self.breaker.record_aborted()
+            raise
+
+        return self._apply_refresh_response(row, msg, failure_tolerance, refresh_request)
+
+    def _check_circuit(self, state: str, msg: dict) -> None:
+        """
+        Part of refresh_by_state, right before request to FDEV, may start half-open probe
+        """
+
+        if not self.breaker.allow():
+            self._on_circuit_open(state, msg)
+
+    def _on_circuit_open(self, state: str, msg: dict) -> None:
+        msg['status'] = 'error'
+        msg['description'] = 'FDEV is unavailable. Try later'
+        raise exceptions.UpstreamUnavailable(msg['description'], msg['status'], state, self.breaker.retry_after)
+
+    def _on_refresh_connection_error(self, state: str, msg: dict, e: Exception) -> None:
+        self.breaker.record_failure()
+        logger.warning(f'Connection problem on refresh for {state!r}', exc_info=e)
+        msg['status'] = 'error'
+        msg['description'] = 'Connection Error'
+        raise exceptions.UpstreamUnavailable(msg['description'], msg['status'], state, self.breaker.retry_after)
+
+    def _on_refresh_throttled(self, state: str, msg: dict, e: exceptions.UpstreamThrottled) -> None:
+        # FDEV wasn't asked, so it isn't a failed refresh and refresh_tries stay as they are
+        self.breaker.record_aborted()
+        msg['status'] = 'error'
+        msg['description'] = 'Too many refreshes at the moment. Try later'
+        raise exceptions.UpstreamUnavailable(msg['description'], msg['status'], state, e.retry_after)
+
+    def _on_refresh_error(self, state: str, msg: dict, e: Exception) -> None:
+        # not FDEV's answer, e.g. rate limiter's DB failed, so it's neither breaker's nor user's business
+        self.breaker.record_aborted()
+        logger.warning(f'Fail on refresh request for {state!r}', exc_info=e)
+        msg['status'] = 'error'
+        msg['description'] = 'Refresh failed. Try later'
+        raise exceptions.RefreshFail(msg['description'], msg['status'], state)
+
+    def _apply_refresh_response(self, row: dict, msg: dict, failure_tolerance: bool, refresh_request) -> dict:
+        """
+        Saves refreshed tokens or handles failed refresh
+
+        :param refresh_request: response of refresh request, requests.Response or httpx.Response
+        """
+
+        state = row['state']
+        if refresh_request.status_code == 418:  # Server's maintenance
+            # not user's fault, so refresh_tries stay as they are
+            self.breaker.record_failure()
+            logger.warning(f'FDEV maintenance 418, text: {refresh_request.text!r}')
+            msg['status'] = 'error'
+            msg['description'] = 'FDEV on maintenance'
+            raise exceptions.UpstreamUnavailable(msg['description'], msg['status'], state, self.breaker.retry_after)
+
+        self.breaker.record_success()
+        try:
+            refresh_request.raise_for_status()
+
+            tokens = refresh_request.json()
+            self.model.set_tokens(
+                access_token=tokens["access_token"],
+                refresh_token=tokens["refresh_token"],
+                expires_in=tokens["expires_in"],
+                timestamp_got_expires_in=int(time.time()),
+                state=state
+            )
+            msg['status'] = 'ok'
+            msg['description'] = 'Token were successfully updated'
+            return msg
+
+        except Exception as e:
+            # probably here something don't work
+            text = ''
+            try:
+                text = refresh_request.text
+
+            except Exception as e1:
+                text = f"can't get text because {e1}"
+
+            logger.warning(
+                f'Fail on refreshing token for {state!r}, row:{row!r}, text: {text}', exc_info=e)
+            msg['status'] = 'error'
+
+            self.model.increment_refresh_tries(state)
+
+            if not failure_tolerance:
+                if row['refresh_tries'] >= 5:  # hardcoded limit
+                    msg['description'] = "Refresh failed. You were removed from DB due to refresh rate limitings"
+                    self.model.delete_row(state)
+                    raise exceptions.RefreshFail(msg['description'], msg['status'], state)
+
+            msg['description'] = "Refresh failed. Try later"
+            raise exceptions.RefreshFail(msg['description'], msg['status'], state)
+
+    def delete_by_state(self, state: str) -> None:
+        self.model.delete_row(state)
+
+    def delete_by_states(self, states: list[str]) -> None:
+        self.model.delete_rows(states)
+
+    def get_random_token(self, least_used: bool = False, attempts: int = 3) -> Union[dict, None]:
+        """
+        Token of random user which refresh isn't known to fail
+
+        :param least_used: prefer less used users
+        :param attempts: how many users to try if refresh of picked one fails
+        :return: None if there are no users or all attempts failed
+        """
+
+        for attempt in range(0, attempts):
+            state = self.model.random_index.pick(least_used=least_used)
+            if state is None:
+                return None
+
+            token = self._get_token_or_none(state)
+            if token is not None and 'access_token' in token:  # To be sure
+                return token
+
+            self.model.random_index.mark_failing(state)  # e.g. it doesn't exist anymore
+
+        return None
+
+    def list_all_valid_users(self) -> list[dict]:
+        return self.model.list_all_valid_records()
+
+    def iter_valid_users(self, fields: list[str], after: str = '', limit: int = -1) -> Iterator[dict]:
+        return self.model.iter_valid_records(fields, after, limit)
+
+    def cleanup_orphans(self) -> None:
+        self.model.cleanup_orphans_records()
+
+    def list_all_records(self) -> list[dict]:
+        return self.model.list_all_records()
+
+
+class ProcessLocalAuthorizer:
+    """
+    Creates CAPIAuthorizer on first use in every process and passes attributes through to it.
+
+    uwsgi imports the app in master and forks workers, so anything created at import (SQLite connections, thread
+    pools, HTTP session) would be shared by workers. web.py warms it up in a uwsgi postfork hook.
+    """
+
+    def __init__(self, db_location: str):
+        self.db_location = db_location
+        self._authorizer: Union[CAPIAuthorizer, None] = None
+        self._pid = None
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()  # could be held by another thread of the parent at fork
+
+    def get(self) -> CAPIAuthorizer:
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._authorizer = CAPIAuthorizer(model.Model(self.db_location))
+                    self._pid = os.getpid()
+
+        return self._authorizer
+
+    def __getattr__(self, name: str):
+        return getattr(self.get(), name)
+
+
+capi_authorizer = ProcessLocalAuthorizer(config.db_location)
@@ -0,0 +1,188 @@
+import asyncio
+import concurrent.futures
+import functools
+import time
+from typing import Union
+
+import config
+from . import async_utils
+from . import exceptions
+from .metrics import metrics, REFRESHES
+from EDMCLogging import get_main_logger
+
+logger = get_main_logger()
+
+
+class AsyncCAPIAuthorizer:
+    """
+    asyncio facade of CAPIAuthorizer for ASGI mode.
+
+    SQLite work goes to a small thread pool, refreshes are done by non-blocking upstream client, so
+    one worker can wait for many slow refreshes at once. Refreshes of the same state are coalesced within
+    the event loop and across processes by the same lease as in CAPIAuthorizer.
+    """
+
+    def __init__(self, authorizer):
+        self.authorizer = authorizer
+        self._db_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.asgi_db_workers,
+            thread_name_prefix='asgi-db'
+        )
+        # for rare blocking operations which involve FDEV, such as login callback
+        self._blocking_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.asgi_blocking_workers,
+            thread_name_prefix='asgi-blocking'
+        )
+        self._refresh_flights: dict[str, asyncio.Future] = dict()
+
+    @property
+    def model(self):
+        return self.authorizer.model  # not at init, authorizer is created on first use
+
+    async def run_db(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._db_executor,
+            functools.partial(func, *args, **kwargs)
+        )
+
+    async def run_blocking(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._blocking_executor,
+            functools.partial(func, *args, **kwargs)
+        )
+
+    async def get_token_by_state(self, state: str) -> Union[dict, None]:
+        row = await self.run_db(self.model.get_fresh_token_for_user, state, config.token_refresh_margin)
+
+        if row is None and self.authorizer.breaker.is_open:
+            # FDEV is down, better to give token which is due refresh than nothing
+            row = await self.run_db(self.model.get_fresh_token_for_user, state, 0)
+
+        if row is None:
+            # No such state or token has to be refreshed
+            try:
+                await self.refresh_by_state(state)
+                row = await self.run_db(self.model.get_token_for_user, state)
+
+            except exceptions.UpstreamUnavailable:
+                # see CAPIAuthorizer.get_token_by_state
+                row = await self.run_db(self.model.get_fresh_token_for_user, state, 0)
+                if row is None:
+                    raise
+
+            except exceptions.CAPIException:
+                return None
+
+            if row is None:
+                return None
+
+        row['expires_over'] = int(row['expires_on']) - int(time.time())
+
+        return row
+
+    async def _get_token_or_none(self, state: str) -> Union[dict, None]:
+        try:
+            return await self.get_token_by_state(state)
+
+        except exceptions.UpstreamUnavailable:
+            return None
+
+    async def get_tokens_by_states(self, states: list[str]) -> dict[str, Union[dict, None]]:
+        unique_states = list(set(states))
+        tokens = await asyncio.gather(*(self._get_token_or_none(state) for state in unique_states))
+        return dict(zip(unique_states, tokens))
+
+    async def get_random_token(self, least_used: bool = False, attempts: int = 3) -> Union[dict, None]:
+        for attempt in range(0, attempts):
+            state = await self.run_db(self.model.random_index.pick, least_used=least_used)
+            if state is None:
+                return None
+
+            token = await self._get_token_or_none(state)
+            if token is not None and 'access_token' in token:  # To be sure
+                return token
+
+            self.model.random_index.mark_failing(state)
+
+        return None
+
+    async def refresh_by_state(self, state: str, force_refresh=False,
+                               failure_tolerance=config.default_failure_tolerance,
+                               refresh_margin: int = config.token_refresh_margin) -> dict:
+        """
+        See CAPIAuthorizer.refresh_by_state
+        """
+
+        try:
+            msg = await self._refresh_by_state(state, force_refresh, failure_tolerance, refresh_margin)
+
+        except exceptions.RefreshFail as e:
+            metrics.inc(REFRESHES, {'status': e.status, 'description': e.message})
+            raise
+
+        metrics.inc(REFRESHES, {'status': msg['status'], 'description': msg['description']})
+        return msg
+
+    async def _refresh_by_state(self, state: str, force_refresh: bool, failure_tolerance: bool,
+                                refresh_margin: int) -> dict:
+        msg = {'status': '', 'description': '', 'state': ''}
+        row = await self.run_db(self.model.get_row, state)
+
+        if not self.authorizer._is_refresh_needed(row, state, msg, force_refresh, refresh_margin):
+            return msg
+
+        if self.authorizer.breaker.is_open:
+            self.authorizer._on_circuit_open(state, msg)
+
+        flight = self._refresh_flights.get(state)
+        if flight is None:
+            flight = asyncio.ensure_future(self._refresh(state, row, failure_tolerance))
+            self._refresh_flights[state] = flight
+            flight.add_done_callback(lambda _: self._refresh_flights.pop(state, None))
+
+        # shield so cancelled waiter (e.g. client went away) doesn't cancel refresh for others
+        return dict(await asyncio.shield(flight))
+
+    async def _refresh(self, state: str, row: dict, failure_tolerance: bool) -> dict:
+        msg = {'status': '', 'description': '', 'state': state}
+        locked_until = await self._acquire_refresh_lock(state)
+        try:
+            fresh_row = await self.run_db(
+                self.authorizer._get_row_after_wait, locked_until is not None, row, state, msg
+            )
+            if fresh_row is None:
+                return msg
+
+            self.authorizer._check_circuit(state, msg)
+            try:
+                refresh_request = await async_utils.refresh_request(fresh_row['refresh_token'])
+
+            except async_utils.CONNECTION_ERRORS as e:
+                self.authorizer._on_refresh_connection_error(state, msg, e)
+
+            except exceptions.UpstreamThrottled as e:
+                self.authorizer._on_refresh_throttled(state, msg, e)
+
+            except Exception as e:
+                self.authorizer._on_refresh_error(state, msg, e)
+
+            except BaseException:
+                self.authorizer.breaker.record_aborted()
+                raise
+
+            return await self.run_db(
+                self.authorizer._apply_refresh_response, fresh_row, msg, failure_tolerance, refresh_request
+            )
+
+        finally:
+            if locked_until is not None:
+                await self.run_db(self.model.release_refresh_lock, state, locked_until)
+
+    async def _acquire_refresh_lock(self, state: str) -> Union[float, None]:
+        deadline = time.monotonic() + config.refresh_wait_timeout
+        while True:
+            locked_until = await self.run_db(self.model.acquire_refresh_lock, state, config.refresh_lock_ttl)
+            if locked_until is not None or time.monotonic() >= deadline:
+                return locked_until
+
+            await asyncio.sleep(0.1)  # another process refreshes this state
@@ -0,0 +1,96 @@
+"""
+Non-blocking counterparts of utils.py for ASGI mode (web_asgi.py).
+
+Uses httpx if it's installed, otherwise falls back to running blocking utils.py functions in a thread pool.
+"""
+
+import asyncio
+import concurrent.futures
+import time
+
+import requests
+
+import config
+from . import exceptions
+from . import utils
+from .metrics import metrics, UPSTREAM_REQUEST_SECONDS
+from .rate_limit import rate_limiter
+
+try:
+    import httpx
+
+except ImportError:
+    httpx = None
+
+if httpx is not None:
+    CONNECTION_ERRORS = (httpx.RequestError,)
+
+else:
+    CONNECTION_ERRORS = (requests.RequestException,)
+
+_client = None
+_fallback_executor = None
+
+
+def _get_client() -> 'httpx.AsyncClient':
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=config.asgi_upstream_max_connections,
+                max_keepalive_connections=config.upstream_pool_maxsize
+            ),
+            timeout=config.upstream_timeout
+        )
+
+    return _client
+
+
+async def _run_blocking(func, *args):
+    global _fallback_executor
+    if _fallback_executor is None:
+        _fallback_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.upstream_pool_maxsize,
+            thread_name_prefix='upstream-fallback'
+        )
+
+    return await asyncio.get_running_loop().run_in_executor(_fallback_executor, func, *args)
+
+
+async def acquire_rate_limit(endpoint: str) -> None:
+    """
+    Non-blocking counterpart of rate_limiter.acquire
+    """
+
+    deadline = time.monotonic() + rate_limiter.max_wait
+    while (wait := await _run_blocking(rate_limiter.try_acquire, endpoint)) > 0:
+        if time.monotonic() + wait > deadline:
+            raise exceptions.UpstreamThrottled(endpoint, wait)
+
+        await asyncio.sleep(wait)
+
+
+async def refresh_request(refresh_token: str):
+    """
+    :return: httpx.Response or requests.Response if httpx isn't installed
+    """
+
+    if httpx is None:
+        return await _run_blocking(utils.refresh_request, refresh_token)
+
+    await acquire_rate_limit('token')
+    with metrics.timer(UPSTREAM_REQUEST_SECONDS, {'endpoint': 'token', 'status': 'error'}) as labels:
+        response = await _get_client().post(
+            url=config.TOKEN_URL,
+            headers=utils.REFRESH_REQUEST_HEADERS,
+            content=utils.refresh_request_body(refresh_token)
+        )
+        labels['status'] = str(response.status_code)
+        return response
+
+
+async def aclose() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
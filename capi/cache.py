@@ -0,0 +1,193 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Union
+
+from . import sqlite_requests
+
+
+class TokenCache:
+    """
+    Per process read-through cache of authorizations rows in front of Model.
+
+    Keeps state -> row and nickname/fid -> state mappings. Row is valid until its token's expires_on.
+    Model invalidates rows it changes itself, changes made by other processes are detected by
+    `pragma data_version` of separate per thread connections, which changes on every commit of any other connection,
+    in such case states from authorizations_changes after the last seen one are invalidated. Commits which don't
+    change cached columns, such as usages flushes and refresh locks, invalidate nothing.
+
+    When it's full, the least recently used row is evicted.
+    """
+
+    def __init__(self, db_location: str, max_entries: int):
+        self.db_location = db_location
+        # separate connections only to watch for commits, including our own process's Model connections, per thread,
+        # so reads don't get serialized on one connection
+        self._watch = threading.local()
+        self._lock = threading.Lock()
+        self._last_change: int = self._watch_db().execute(sqlite_requests.select_last_change).fetchone()[0]
+        self.max_entries = max_entries
+
+        self._rows: OrderedDict[str, dict] = OrderedDict()
+        self._state_by_fid: dict[str, str] = dict()
+        self._state_by_nickname: dict[str, str] = dict()
+
+        # incremented on every invalidation, so a row read from DB before invalidation won't get into cache after it
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def _watch_db(self) -> sqlite3.Connection:
+        watch_db = getattr(self._watch, 'db', None)
+        if watch_db is None:
+            watch_db = self._watch.db = sqlite3.connect(self.db_location)
+            self._watch.data_version = None
+
+        return watch_db
+
+    def _sync(self) -> None:
+        watch_db = self._watch_db()
+        data_version = watch_db.execute(sqlite_requests.select_data_version).fetchone()[0]
+        if data_version == self._watch.data_version:
+            return  # nothing was committed since this thread looked last time
+
+        self._watch.data_version = data_version
+        with self._lock:
+            changes = watch_db.execute(
+                sqlite_requests.select_changes_since, {'seq': self._last_change}
+            ).fetchall()
+            if len(changes) == 0:
+                return
+
+            if changes[0][0] != self._last_change + 1:
+                self._clear()  # changes we haven't seen were pruned already
+
+            else:
+                self.generation += 1
+                for _, state in changes:
+                    self._rows.pop(state, None)
+
+            self._last_change = changes[-1][0]
+
+    def _clear(self) -> None:
+        self.generation += 1
+        self._rows.clear()
+        self._state_by_fid.clear()
+        self._state_by_nickname.clear()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clear()
+
+    def invalidate(self, state: str) -> None:
+        with self._lock:
+            self.generation += 1
+            self._rows.pop(state, None)
+
+    def _get_valid_row(self, state: str) -> Union[dict, None]:
+        row = self._rows.get(state)
+        if row is None:
+            return None
+
+        if int(row['timestamp_got_expires_in']) + int(row['expires_in']) <= time.time():
+            self._rows.pop(state, None)
+            return None
+
+        try:
+            self._rows.move_to_end(state)
+
+        except KeyError:
+            pass  # invalidated or evicted meanwhile, the row we've got is still a valid one to return
+
+        return row
+
+    def _evict(self) -> None:
+        """
+        Drops the least recently used row and mappings to it, must be called under the lock
+        """
+
+        state, row = self._rows.popitem(last=False)
+        if self._state_by_fid.get(row['fid']) == state:
+            del self._state_by_fid[row['fid']]
+
+        if row['nickname'] is not None and self._state_by_nickname.get(self._key('nickname', row['nickname'])) == state:
+            del self._state_by_nickname[self._key('nickname', row['nickname'])]
+
+    def get_row(self, state: str) -> Union[dict, None]:
+        self._sync()
+        row = self._get_valid_row(state)
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return dict(row)
+
+    def _get_state_by(self, mapping: dict[str, str], column: str, value: str) -> Union[str, None]:
+        self._sync()
+        state = mapping.get(value)
+        if state is not None:
+            row = self._get_valid_row(state)
+            # mapping is valid only as long as row it points to is cached and still has the same value
+            if row is not None and row[column] is not None and self._key(column, row[column]) == value:
+                self.hits += 1
+                return state
+
+            mapping.pop(value, None)
+
+        self.misses += 1
+        return None
+
+    @staticmethod
+    def _key(column: str, value: str) -> str:
+        if column == 'nickname':
+            return value.lower()  # nicknames are looked up case insensitively
+
+        return value
+
+    def get_state_by_fid(self, fid: str) -> Union[str, None]:
+        return self._get_state_by(self._state_by_fid, 'fid', fid)
+
+    def get_state_by_nickname(self, nickname: str) -> Union[str, None]:
+        return self._get_state_by(self._state_by_nickname, 'nickname', self._key('nickname', nickname))
+
+    def put_row(self, row: dict, generation: int) -> None:
+        """
+        Cache row read from DB
+
+        :param row:
+        :param generation: value of self.generation taken before reading the row from DB
+        :return:
+        """
+
+        if self.max_entries <= 0:
+            return
+
+        if row is None or row['access_token'] is None or row['fid'] is None:
+            return  # only complete authorizations are worth caching
+
+        if int(row['timestamp_got_expires_in']) + int(row['expires_in']) <= time.time():
+            return
+
+        with self._lock:
+            if generation != self.generation:
+                return  # something was invalidated while we were reading, the row may be stale
+
+            self._rows.pop(row['state'], None)
+            while len(self._rows) >= self.max_entries:
+                self._evict()
+
+            self._rows[row['state']] = dict(row)
+            self._state_by_fid[row['fid']] = row['state']
+            if row['nickname'] is not None:
+                self._state_by_nickname[self._key('nickname', row['nickname'])] = row['state']
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._rows),
+            'max_entries': self.max_entries
+        }
@@ -0,0 +1,107 @@
+import threading
+import time
+
+from EDMCLogging import get_main_logger
+
+logger = get_main_logger()
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker:
+    """
+    Process wide circuit breaker for requests to FDEV.
+
+    Opens after `failure_threshold` failures in a row, then requests are short-circuited for `cooldown` seconds,
+    after that exactly one probe request is let through (half-open), its result closes or reopens the circuit.
+
+    Every call which got True from allow() must be finished by one of record_success(), record_failure()
+    or record_aborted().
+    """
+
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    @property
+    def is_open(self) -> bool:
+        """
+        If requests would be short-circuited now, unlike allow() doesn't start a probe
+        """
+
+        with self._lock:
+            if self._state == OPEN:
+                return time.monotonic() - self._opened_at < self.cooldown
+
+            return self._state == HALF_OPEN and self._probing
+
+    @property
+    def retry_after(self) -> float:
+        """
+        Seconds until the circuit lets a probe through, 0 if it isn't open
+        """
+
+        with self._lock:
+            if self._state == OPEN:
+                return max(0.0, self.cooldown - (time.monotonic() - self._opened_at))
+
+            return 0.0
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+
+            if self._state == OPEN:
+                if time.monotonic() - self._opened_at < self.cooldown:
+                    return False
+
+                self._state = HALF_OPEN
+
+            if self._probing:
+                return False
+
+            self._probing = True
+            logger.info('Circuit to FDEV is half-open, probing')
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._state != CLOSED:
+                logger.info('Circuit to FDEV is closed')
+
+            self._state = CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._state == OPEN:
+                return  # requests which were in flight when it opened, don't prolong cooldown
+
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                logger.warning(f'Circuit to FDEV is open for {self.cooldown}s after {self._failures} failures')
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def record_aborted(self) -> None:
+        """
+        Request wasn't made after all (e.g. rate limited), let somebody else probe
+        """
+
+        with self._lock:
+            self._probing = False
@@ -0,0 +1,117 @@
+import re
+import sqlite3
+import threading
+import time
+
+import config
+from . import sqlite_requests
+from .metrics import metrics, SQLITE_EXECUTE_SECONDS
+
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+
+def dict_factory(cursor: sqlite3.Cursor, row: tuple) -> dict:
+    return dict(zip([col[0] for col in cursor.description], row))
+
+
+def _statements_names() -> tuple[dict[str, str], list[tuple[re.Pattern, str]]]:
+    """
+    :return: {sql: name} of sqlite_requests statements and [(pattern, name)] of templates, such as select_valid_page
+    """
+
+    names = dict()
+    templates = list()
+    for name, sql in vars(sqlite_requests).items():
+        if name.startswith('_') or not isinstance(sql, str):
+            continue
+
+        if '{' in sql:
+            pattern = re.escape(sql)
+            pattern = re.sub(r'\\\{\w+\\\}', '.*?', pattern)
+            templates.append((re.compile(pattern, re.DOTALL), name))
+
+        else:
+            names[sql] = name
+
+    return names, templates
+
+
+_statements, _templates = _statements_names()
+
+
+def statement_name(sql: str) -> str:
+    name = _statements.get(sql)
+    if name is not None:
+        return name
+
+    for pattern, name in _templates:
+        if pattern.fullmatch(sql):
+            return name
+
+    return 'other'
+
+
+class TimedConnection(sqlite3.Connection):
+    """
+    Measures statements execution time by their names in sqlite_requests, time of fetching rows isn't counted
+    """
+
+    def execute(self, sql: str, parameters=(), /) -> sqlite3.Cursor:
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+
+        finally:
+            metrics.observe(SQLITE_EXECUTE_SECONDS, {'statement': statement_name(sql)}, time.perf_counter() - started)
+
+    def executemany(self, sql: str, parameters, /) -> sqlite3.Cursor:
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+
+        finally:
+            metrics.observe(SQLITE_EXECUTE_SECONDS, {'statement': statement_name(sql)}, time.perf_counter() - started)
+
+
+class ConnectionManager:
+    """
+    Gives every thread its own connection to the DB, so threads don't get serialized on one shared connection.
+
+    DB is switched to WAL, so readers don't wait for writers (and vice versa).
+    """
+
+    def __init__(self, db_location: str):
+        self.db_location = db_location
+        self._local = threading.local()
+
+        assert config.sqlite_synchronous in SYNCHRONOUS_MODES, f'sqlite_synchronous must be one of {SYNCHRONOUS_MODES}'
+
+        # journal mode is persistent, so it's enough to set it once
+        self.get().execute('pragma journal_mode = wal;')
+
+    def _connect(self) -> sqlite3.Connection:
+        # timeout sets busy_timeout
+        connection = sqlite3.connect(
+            self.db_location,
+            timeout=config.sqlite_busy_timeout / 1000,
+            factory=TimedConnection
+        )
+        connection.row_factory = dict_factory
+        connection.execute(f'pragma synchronous = {config.sqlite_synchronous};')
+        connection.execute(f'pragma cache_size = {int(config.sqlite_cache_size)};')
+        connection.execute(f'pragma mmap_size = {int(config.sqlite_mmap_size)};')
+        return connection
+
+    def get(self) -> sqlite3.Connection:
+        """
+        Connection of current thread, it gets closed along with the thread
+
+        :return:
+        """
+
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._connect()
+            self._local.connection = connection
+
+        return connection
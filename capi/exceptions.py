@@ -1,14 +1,32 @@
-class CAPIException(Exception):
-    pass
-
-
-class RefreshFail(CAPIException):
-    def __init__(self, message: str, status: str, state: str):
-        self.message = message
-        self.status = status
-        self.state = state
-        super().__init__(str(self.message) + ' for ' + str(self.state))
-
-
-class NoFID(Exception):
-    pass
+class CAPIException(Exception):
+    pass
+
+
+class RefreshFail(CAPIException):
+    def __init__(self, message: str, status: str, state: str):
+        self.message = message
+        self.status = status
+        self.state = state
+        super().__init__(str(self.message) + ' for ' + str(self.state))
+
+
+class UpstreamUnavailable(RefreshFail):
+    """
+    Refresh failed because of FDEV, not because of the token: maintenance, connection error, open circuit, our own
+    rate limit or too long concurrent refresh, so still valid token can be used meanwhile
+    """
+
+    def __init__(self, message: str, status: str, state: str, retry_after: float = 0):
+        self.retry_after = retry_after  # seconds, when it makes sense to try again
+        super().__init__(message, status, state)
+
+
+class UpstreamThrottled(CAPIException):
+    def __init__(self, endpoint: str, retry_after: float):
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+        super().__init__(f'Too many requests to FDEV {endpoint} endpoint, retry after {retry_after:.1f}s')
+
+
+class NoFID(Exception):
+    pass
@@ -0,0 +1,337 @@
+"""
+Prometheus-style metrics, aggregated across uwsgi processes.
+
+Every process keeps its metrics in memory and dumps them to its own file in config.metrics_dir every
+config.metrics_flush_interval seconds, scrape sums files of all processes. When a process exits, its file is merged
+into DEAD_FILE and removed, so counters don't go down when a worker gets respawned and the directory doesn't grow.
+Files of processes which died without cleanup (e.g. killed) are merged at scrape.
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import threading
+import time
+from typing import Iterator, Union
+
+import config
+from EDMCLogging import get_main_logger
+from process_local import ProcessLocal
+
+logger = get_main_logger()
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+HTTP_REQUEST_SECONDS = 'capi_http_request_duration_seconds'
+UPSTREAM_REQUEST_SECONDS = 'capi_upstream_request_duration_seconds'
+REFRESHES = 'capi_refreshes_total'
+SQLITE_EXECUTE_SECONDS = 'capi_sqlite_execute_seconds'
+AUTHORIZATIONS_ROWS = 'capi_authorizations_rows'
+
+DESCRIPTIONS = {
+    HTTP_REQUEST_SECONDS: (HISTOGRAM, 'Time to handle request, by route template, method and status'),
+    UPSTREAM_REQUEST_SECONDS: (HISTOGRAM, 'Time of requests to FDEV, by endpoint and status'),
+    REFRESHES: (COUNTER, 'Results of refresh_by_state, by status and description'),
+    SQLITE_EXECUTE_SECONDS: (HISTOGRAM, 'Time of SQLite statements execution, by name in sqlite_requests'),
+    AUTHORIZATIONS_ROWS: (GAUGE, 'Rows in authorizations table')
+}
+
+# sum of files of exited processes
+DEAD_FILE = 'dead.json'
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in labels]
+    if extra:
+        pairs.append(extra)
+
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _file_pid(file_name: str) -> Union[int, None]:
+    """
+    :return: pid of the process which writes {pid}-{time_ns}.json, None for other files
+    """
+
+    pid, _, rest = file_name.partition('-')
+    if not pid.isdigit() or not rest.endswith('.json'):
+        return None
+
+    return int(pid)
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+
+    except ProcessLookupError:
+        return False
+
+    except PermissionError:
+        return True  # exists, but isn't ours
+
+    return True
+
+
+def _merge(counters: dict, histograms: dict, dump: dict) -> None:
+    """
+    Adds file's dump to counters and histograms, which are in the same shape as in memory
+    """
+
+    for name, labels, value in dump['counters']:
+        key = (name, tuple(tuple(pair) for pair in labels))
+        counters[key] = counters.get(key, 0) + value
+
+    for name, labels, values in dump['histograms']:
+        key = (name, tuple(tuple(pair) for pair in labels))
+        histogram = histograms.setdefault(key, [0] * len(values))
+        for i, value in enumerate(values):
+            histogram[i] += value
+
+
+def _dump(counters: dict, histograms: dict) -> dict:
+    return {
+        'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+        'histograms': [[name, labels, list(values)] for (name, labels), values in histograms.items()]
+    }
+
+
+def _write(path: str, dump: dict) -> None:
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w') as file:
+        json.dump(dump, file)
+
+    os.replace(tmp_file, path)  # so scrape never reads half written file
+
+
+class Metrics:
+    def __init__(self, directory: str, flush_interval: float):
+        self.directory = directory
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # flush thread and scrape write the same file
+        self._counters: dict[tuple[str, tuple], float] = dict()
+        # (name, labels) -> [count per bucket..., +Inf count, sum]
+        self._histograms: dict[tuple[str, tuple], list] = dict()
+        self._file: Union[str, None] = None
+        self._retired = False  # the file was merged into DEAD_FILE, nothing is to be flushed anymore
+        self._process = ProcessLocal(
+            'metrics-flush', on_start=self._start, loop=self.flush, interval=flush_interval, at_exit=self.retire
+        )
+
+    def _start(self) -> None:
+        self._counters.clear()  # they belong to parent process and are in its file
+        self._histograms.clear()
+        # not just pid, as pids get reused
+        self._file = os.path.join(self.directory, f'{os.getpid()}-{time.time_ns()}.json')
+        self._retired = False
+
+    def inc(self, name: str, labels: dict, value: float = 1) -> None:
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._process.start()
+
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: dict, value: float) -> None:
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._process.start()
+
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = [0] * (len(BUCKETS) + 2)
+                self._histograms[key] = histogram
+
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+
+            else:
+                histogram[len(BUCKETS)] += 1
+
+            histogram[-1] += value
+
+    @contextlib.contextmanager
+    def timer(self, name: str, labels: dict) -> Iterator[dict]:
+        """
+        Observe duration of the block, labels can be amended inside the block, e.g. with response status
+        """
+
+        started = time.perf_counter()
+        try:
+            yield labels
+
+        finally:
+            self.observe(name, labels, time.perf_counter() - started)
+
+    def flush(self) -> None:
+        # snapshot under the same lock as writing, so older snapshot never overwrites newer one
+        with self._flush_lock:
+            with self._lock:
+                if not self._process.started or self._retired:
+                    return  # nothing was recorded by this process or it's exiting
+
+                dump = _dump(self._counters, self._histograms)
+
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                _write(self._file, dump)
+
+            except Exception as e:
+                logger.warning(f"Couldn't flush metrics to {self._file!r}", exc_info=e)
+
+    @contextlib.contextmanager
+    def _dir_lock(self, operation: int) -> Iterator[None]:
+        """
+        Exclusive for merging files into DEAD_FILE, shared for reading, so a scrape never sees a file both
+        merged and not yet removed
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, operation)
+            try:
+                yield
+
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _merge_into_dead(self, file_names: list[str]) -> None:
+        """
+        Must be called under exclusive _dir_lock
+        """
+
+        counters: dict[tuple[str, tuple], float] = dict()
+        histograms: dict[tuple[str, tuple], list] = dict()
+        for file_name in [DEAD_FILE] + file_names:
+            try:
+                with open(os.path.join(self.directory, file_name)) as file:
+                    _merge(counters, histograms, json.load(file))
+
+            except FileNotFoundError:
+                continue
+
+        _write(os.path.join(self.directory, DEAD_FILE), _dump(counters, histograms))
+        for file_name in file_names:
+            os.remove(os.path.join(self.directory, file_name))
+
+    def retire(self) -> None:
+        """
+        Merges this process's metrics into DEAD_FILE and removes its file, at exit
+        """
+
+        self.flush()
+        with self._flush_lock:
+            if not self._process.started or self._retired:
+                return
+
+            self._retired = True
+            try:
+                with self._dir_lock(fcntl.LOCK_EX):
+                    self._merge_into_dead([os.path.basename(self._file)])
+
+            except Exception as e:
+                logger.warning(f"Couldn't merge metrics of exited process {self._file!r}", exc_info=e)
+
+    def _retire_dead(self) -> None:
+        """
+        Merges files of processes which exited without retire(), e.g. were killed
+        """
+
+        dead = [
+            file_name for file_name in os.listdir(self.directory)
+            if (pid := _file_pid(file_name)) is not None and pid != os.getpid() and not _is_alive(pid)
+        ]
+        if len(dead) == 0:
+            return
+
+        try:
+            with self._dir_lock(fcntl.LOCK_EX):
+                # somebody could merge them meanwhile
+                self._merge_into_dead([name for name in dead if os.path.exists(os.path.join(self.directory, name))])
+
+        except Exception as e:
+            logger.warning(f"Couldn't merge metrics of dead processes {dead!r}", exc_info=e)
+
+    def _collect(self) -> tuple[dict, dict]:
+        """
+        Sum metrics of all processes
+
+        :return: counters and histograms in the same shape as in memory
+        """
+
+        counters: dict[tuple[str, tuple], float] = dict()
+        histograms: dict[tuple[str, tuple], list] = dict()
+        if not os.path.isdir(self.directory):
+            return counters, histograms
+
+        self._retire_dead()
+        with self._dir_lock(fcntl.LOCK_SH):
+            for file_name in os.listdir(self.directory):
+                if not file_name.endswith('.json'):
+                    continue
+
+                try:
+                    with open(os.path.join(self.directory, file_name)) as file:
+                        _merge(counters, histograms, json.load(file))
+
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Couldn't read metrics file {file_name!r}", exc_info=e)
+
+        return counters, histograms
+
+    def render(self, gauges: dict[str, float]) -> str:
+        """
+        All processes metrics in Prometheus text format
+
+        :param gauges: {name: value} of gauges which are computed at scrape time
+        :return:
+        """
+
+        self.flush()
+        counters, histograms = self._collect()
+
+        by_name: dict[str, list[str]] = {name: list() for name in DESCRIPTIONS}
+        for (name, labels), value in sorted(counters.items()):
+            by_name.setdefault(name, list()).append(f'{name}{_format_labels(labels)} {value}')
+
+        for (name, labels), values in sorted(histograms.items()):
+            lines = by_name.setdefault(name, list())
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), values):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(labels, f"le={json.dumps(str(bound))}")} {cumulative}')
+
+            lines.append(f'{name}_sum{_format_labels(labels)} {values[-1]}')
+            lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+
+        for name, value in gauges.items():
+            by_name.setdefault(name, list()).append(f'{name} {value}')
+
+        output = list()
+        for name, lines in by_name.items():
+            kind, description = DESCRIPTIONS.get(name, ('untyped', ''))
+            output.append(f'# HELP {name} {description}')
+            output.append(f'# TYPE {name} {kind}')
+            output.extend(lines)
+
+        return '\n'.join(output) + '\n'
+
+
+metrics = Metrics(config.metrics_dir, config.metrics_flush_interval)
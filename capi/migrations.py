@@ -0,0 +1,107 @@
+"""
+Versioned schema migrations, they are applied at Model.__init__.
+
+`pragma user_version` holds number of the last applied migration, so to change schema append a new function
+to MIGRATIONS, never edit already released ones.
+"""
+
+import fcntl
+import sqlite3
+from typing import Callable
+
+import config
+from . import sqlite_requests
+from EDMCLogging import get_main_logger
+
+logger = get_main_logger()
+
+
+def _v1_initial(db: sqlite3.Connection) -> None:
+    # Legacy DBs already have it, user_version is 0 for them as well as for new ones
+    with db:
+        db.execute(sqlite_requests.schema)
+        db.execute(sqlite_requests.refresh_locks_schema)
+
+
+def _v2_typed_and_indexed(db: sqlite3.Connection) -> None:
+    """
+    Rebuilds authorizations with integer expires_in and timestamp_got_expires_in and adds indexes.
+
+    Rows are copied in batches in separate transactions, so other processes still can use the table meanwhile,
+    their changes get into new table by triggers.
+    """
+
+    with db:
+        for query in sqlite_requests.v2_cleanup:  # leftovers of interrupted attempt
+            db.execute(query)
+
+        db.execute(sqlite_requests.v2_schema)
+        for query in sqlite_requests.v2_triggers:
+            db.execute(query)
+
+    last_rowid = 0
+    while True:
+        with db:
+            end = db.execute(
+                sqlite_requests.v2_backfill_batch_end,
+                {'last_rowid': last_rowid, 'batch_size': config.migration_batch_size}
+            ).fetchone()
+            end_rowid = None if end is None else end['rowid']
+
+            db.execute(sqlite_requests.v2_backfill, {'last_rowid': last_rowid, 'end_rowid': end_rowid})
+
+        if end_rowid is None:
+            break  # it was the last batch
+
+        logger.info(f'Backfilled authorizations up to rowid {end_rowid}')
+        last_rowid = end_rowid
+
+    db.execute('begin immediate;')
+    try:
+        for query in sqlite_requests.v2_swap:
+            db.execute(query)
+
+    except Exception:
+        db.rollback()
+        raise
+
+    # commit is done by migrate() along with user_version bump
+
+
+def _v3_changes_log(db: sqlite3.Connection) -> None:
+    with db:
+        db.execute(sqlite_requests.v3_changes_schema)
+        for query in sqlite_requests.v3_changes_triggers:
+            db.execute(query)
+
+
+MIGRATIONS: list[Callable[[sqlite3.Connection], None]] = [
+    _v1_initial,
+    _v2_typed_and_indexed,
+    _v3_changes_log
+]
+
+
+def migrate(db: sqlite3.Connection, db_location: str) -> None:
+    """
+    Applies not yet applied migrations. Lock file makes sure only one process migrates at time,
+    others wait and then find nothing to do.
+
+    :param db:
+    :param db_location:
+    :return:
+    """
+
+    with open(f'{db_location}.migration-lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            version: int = db.execute('pragma user_version;').fetchone()['user_version']
+
+            for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                logger.info(f'Applying DB migration {number}: {migration.__name__}')
+                migration(db)
+                with db:
+                    db.execute(f'pragma user_version = {number};')
+
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
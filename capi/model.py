@@ -1,147 +1,390 @@
-import sqlite3
-from typing import Union
-
-import config
-from . import sqlite_requests
-from EDMCLogging import get_main_logger
-
-logger = get_main_logger()
-
-
-class Model:
-    def __init__(self, db_location: str):
-        self.db: sqlite3.Connection = sqlite3.connect(db_location, check_same_thread=False)
-        self.db.row_factory = lambda c, r: dict(zip([col[0] for col in c.description], r))
-        with self.db:
-            self.db.execute(sqlite_requests.schema)
-
-    def auth_init(self, verifier: str, state: str) -> None:
-        with self.db:
-            self.db.execute(
-                sqlite_requests.insert_auth_init,
-                {
-                    'code_verifier': verifier,
-                    'state': state
-                })
-
-    def get_verifier(self, state: str) -> str:
-        code_verifier_req = self.db.execute(sqlite_requests.select_all_by_state, {'state': state}).fetchone()
-
-        if code_verifier_req is None:
-            # Somebody got here not by frontier redirect
-            raise KeyError('No state in DB found')
-
-        code_verifier: str = code_verifier_req['code_verifier']
-
-        return code_verifier
-
-    def set_code(self, code: str, state: str) -> None:
-        with self.db:
-            self.db.execute(sqlite_requests.set_code_state, {'code': code, 'state': state})
-
-    def delete_row(self, state: str) -> None:
-        with self.db:
-            self.db.execute(sqlite_requests.delete_by_state, {'state': state})
-
-    def set_tokens(self, access_token: str, refresh_token: str, expires_in: int, timestamp_got_expires_in: int,
-                   state: str) -> None:
-
-        with self.db:
-            self.db.execute(
-                sqlite_requests.set_tokens_by_state,
-                {
-                    'access_token': access_token,
-                    'refresh_token': refresh_token,
-                    'expires_in': expires_in,
-                    'timestamp_got_expires_in': timestamp_got_expires_in,
-                    'state': state
-                 })
-
-    def set_fid(self, fid: str, state: str) -> bool:
-        """
-        Return True if inserted successfully, False if catch sqlite3.IntegrityError
-
-        :param fid:
-        :param state:
-        :return:
-        """
-
-        try:
-            with self.db:
-                self.db.execute(
-                    sqlite_requests.set_fid_by_state,
-                    {'fid': fid, 'state': state}
-                )
-            return True
-
-        except sqlite3.IntegrityError:
-            """
-            let's migrate new received data to old state
-            1. Get old state by fid
-            2. Remove row with old state
-            3. Set old state where new state
-            """
-            state_to_set: str = self.get_state_by_fid(fid)
-            self.delete_row(state_to_set)
-            self.set_new_state(state_to_set, state)
-            with self.db:
-                self.db.execute(
-                    sqlite_requests.set_fid_by_state,
-                    {'fid': fid, 'state': state_to_set}
-                )
-            return False
-
-    def set_nickname(self, nickname: Union[str, None], state: str) -> None:
-        with self.db:
-            self.db.execute(
-                sqlite_requests.set_nickname_by_state,
-                {'nickname': nickname, 'state': state}
-            )
-
-    def get_state_by_nickname(self, nickname: str) -> Union[None, str]:
-        with self.db:
-            nickname_f1 = self.db.execute(sqlite_requests.get_state_by_nickname, {'nickname': nickname}).fetchone()
-
-            if nickname_f1 is None:
-                return None
-
-            return nickname_f1['state']
-
-    def get_state_by_fid(self, fid: str) -> Union[None, str]:
-        with self.db:
-            fid_req_dict = self.db.execute(sqlite_requests.get_state_by_fid, {'fid': fid}).fetchone()
-
-            if fid_req_dict is None:
-                return None
-
-            return fid_req_dict['state']
-
-    def set_new_state(self, new_state: str, old_state: str) -> None:
-        with self.db:
-            self.db.execute(sqlite_requests.update_state_by_state, {'new_state': new_state, 'state': old_state})
-
-    def get_row(self, state: str) -> dict:
-        return self.db.execute(sqlite_requests.select_all_by_state, {'state': state}).fetchone()
-
-    def increment_refresh_tries(self, state: str) -> None:
-        with self.db:
-            self.db.execute(sqlite_requests.refresh_times_increment, {'state': state})
-
-    def get_token_for_user(self, state: str) -> dict:
-        sql_params = {'state': state}
-        token = self.db.execute(sqlite_requests.get_token_for_user, sql_params).fetchone()
-        if not config.do_skip_token_usage_increment:
-            with self.db:
-                self.db.execute(sqlite_requests.increment_usages, sql_params)
-
-        return token
-
-    def list_all_valid_records(self) -> list:
-        return self.db.execute(sqlite_requests.select_nickname_state_all).fetchall()
-
-    def cleanup_orphans_records(self) -> None:
-        with self.db:
-            self.db.execute(sqlite_requests.del_orphans)
-
-    def list_all_records(self) -> list[dict]:
-        return self.db.execute(sqlite_requests.select_all).fetchall()
+import sqlite3
+import time
+from typing import Iterator, Union
+
+import config
+from . import cache
+from . import db
+from . import migrations
+from . import random_index
+from . import sqlite_requests
+from . import usage
+from EDMCLogging import get_main_logger
+
+logger = get_main_logger()
+
+
+class Model:
+    def __init__(self, db_location: str):
+        self.connections = db.ConnectionManager(db_location)
+        migrations.migrate(self.db, db_location)
+
+        self.random_index = random_index.RandomUserIndex(self.connections.get, config.random_index_resync_interval)
+        self.usages = usage.UsageCounter(self._add_usages, config.usage_flush_interval, config.usage_max_pending)
+
+        self.cache = cache.TokenCache(db_location, config.token_cache_size)
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        return self.connections.get()
+
+    def auth_init(self, verifier: str, state: str) -> None:
+        with self.db:
+            self.db.execute(
+                sqlite_requests.insert_auth_init,
+                {
+                    'code_verifier': verifier,
+                    'state': state
+                })
+
+    def get_verifier(self, state: str) -> str:
+        code_verifier_req = self.db.execute(sqlite_requests.select_all_by_state, {'state': state}).fetchone()
+
+        if code_verifier_req is None:
+            # Somebody got here not by frontier redirect
+            raise KeyError('No state in DB found')
+
+        code_verifier: str = code_verifier_req['code_verifier']
+
+        return code_verifier
+
+    def delete_row(self, state: str) -> None:
+        with self.db:
+            self.db.execute(sqlite_requests.delete_by_state, {'state': state})
+
+        self.cache.invalidate(state)
+        self.random_index.remove(state)
+
+    def delete_rows(self, states: list[str]) -> None:
+        with self.db:
+            for chunk in self._chunks(states):
+                self.db.execute(self._in_query(sqlite_requests.delete_by_states, chunk), chunk)
+
+        for state in states:
+            self.cache.invalidate(state)
+            self.random_index.remove(state)
+
+    @staticmethod
+    def _chunks(values: list[str]) -> list[list[str]]:
+        # keep away from SQLITE_MAX_VARIABLE_NUMBER
+        return [values[i:i + config.sqlite_max_variables] for i in range(0, len(values), config.sqlite_max_variables)]
+
+    @staticmethod
+    def _in_query(query_template: str, values: list) -> str:
+        return query_template.format(placeholders=', '.join('?' * len(values)))
+
+    def _select_rows_in(self, query_template: str, values: list[str]) -> list[dict]:
+        generation = self.cache.generation
+        rows = list()
+        for chunk in self._chunks(values):
+            rows.extend(self.db.execute(self._in_query(query_template, chunk), chunk).fetchall())
+
+        for row in rows:
+            self.cache.put_row(row, generation)  # so following get_fresh_token_for_user() hits the cache
+
+        return rows
+
+    def get_existing_states(self, states: list[str]) -> dict[str, Union[str, None]]:
+        """
+        Bulk version of existence check
+
+        :param states:
+        :return: {state: state or None if there is no such state}
+        """
+        found = {row['state'] for row in self._select_rows_in(sqlite_requests.select_all_by_states, states)}
+        return {state: state if state in found else None for state in states}
+
+    def get_states_by_fids(self, fids: list[str]) -> dict[str, Union[str, None]]:
+        """
+        Bulk version of get_state_by_fid
+
+        :param fids:
+        :return: {fid: state or None if there is no such fid}
+        """
+        found = {row['fid']: row['state'] for row in self._select_rows_in(sqlite_requests.select_all_by_fids, fids)}
+        return {fid: found.get(fid) for fid in fids}
+
+    def get_states_by_nicknames(self, nicknames: list[str]) -> dict[str, Union[str, None]]:
+        """
+        Bulk version of get_state_by_nickname
+
+        :param nicknames:
+        :return: {nickname: state or None if there is no such nickname}
+        """
+        found = {
+            row['nickname'].lower(): row['state']
+            for row in self._select_rows_in(sqlite_requests.select_all_by_nicknames, nicknames)
+        }
+        return {nickname: found.get(nickname.lower()) for nickname in nicknames}
+
+    def set_tokens(self, access_token: str, refresh_token: str, expires_in: int, timestamp_got_expires_in: int,
+                   state: str) -> None:
+
+        with self.db:
+            self.db.execute(
+                sqlite_requests.set_tokens_by_state,
+                {
+                    'access_token': access_token,
+                    'refresh_token': refresh_token,
+                    'expires_in': expires_in,
+                    'timestamp_got_expires_in': timestamp_got_expires_in,
+                    'state': state
+                 })
+
+        self.cache.invalidate(state)
+        self.random_index.mark_refreshed(state)  # set_tokens resets refresh_tries
+
+    def save_login(self, code: str, access_token: str, refresh_token: str, expires_in: int,
+                   timestamp_got_expires_in: int, nickname: Union[str, None], fid: str, state: str) -> tuple[bool, str]:
+        """
+        Saves results of completed login in one transaction. If the fid already has a row, new data is migrated
+        to old state, so commander's state doesn't change across logins
+
+        :raises KeyError: if there is no row for the state, nothing is changed then
+        :return: (True if it's a new fid, state the tokens were saved for)
+        """
+
+        with self.db:
+            self.db.execute('begin immediate;')  # we are going to write anyway, so take write lock right away
+            old_row = self.db.execute(sqlite_requests.select_other_state_by_fid, {'fid': fid, 'state': state}).fetchone()
+
+            new_state = state
+            if old_row is not None:
+                new_state = old_row['state']
+                if nickname is None:
+                    nickname = old_row['nickname']  # don't lose it while new one is on its way
+
+                self.db.execute(sqlite_requests.delete_by_state, {'state': new_state})
+
+            updated = self.db.execute(
+                sqlite_requests.save_login_by_state,
+                {
+                    'new_state': new_state,
+                    'code': code,
+                    'access_token': access_token,
+                    'refresh_token': refresh_token,
+                    'expires_in': expires_in,
+                    'timestamp_got_expires_in': timestamp_got_expires_in,
+                    'nickname': nickname,
+                    'fid': fid,
+                    'state': state
+                }
+            ).rowcount
+
+            if updated == 0:
+                # pending row is gone, i.e. cleaned as orphan during login, raise to roll back the old row deletion
+                raise KeyError(f'No such state: {state!r}')
+
+        self.cache.invalidate(state)
+        self.cache.invalidate(new_state)
+        self.random_index.remove(state)
+        self.random_index.add(new_state)
+
+        return old_row is None, new_state
+
+    def set_nickname_by_fid(self, nickname: str, fid: str) -> None:
+        with self.db:
+            rows = self.db.execute(
+                sqlite_requests.set_nickname_by_fid,
+                {'nickname': nickname, 'fid': fid}
+            ).fetchall()
+
+        for row in rows:
+            self.cache.invalidate(row['state'])
+
+    def get_state_by_nickname(self, nickname: str) -> Union[None, str]:
+        state = self.cache.get_state_by_nickname(nickname)
+        if state is not None:
+            return state
+
+        # Select whole row, so following get_row() for the state will hit the cache
+        generation = self.cache.generation
+        row = self.db.execute(sqlite_requests.select_all_by_nickname, {'nickname': nickname}).fetchone()
+        if row is None:
+            return None
+
+        self.cache.put_row(row, generation)
+        return row['state']
+
+    def get_state_by_fid(self, fid: str) -> Union[None, str]:
+        state = self.cache.get_state_by_fid(fid)
+        if state is not None:
+            return state
+
+        generation = self.cache.generation
+        row = self.db.execute(sqlite_requests.select_all_by_fid, {'fid': fid}).fetchone()
+        if row is None:
+            return None
+
+        self.cache.put_row(row, generation)
+        return row['state']
+
+    def get_row(self, state: str) -> dict:
+        row = self.cache.get_row(state)
+        if row is not None:
+            return row
+
+        generation = self.cache.generation
+        row = self.db.execute(sqlite_requests.select_all_by_state, {'state': state}).fetchone()
+        self.cache.put_row(row, generation)
+        return row
+
+    def increment_refresh_tries(self, state: str) -> None:
+        with self.db:
+            self.db.execute(sqlite_requests.refresh_times_increment, {'state': state})
+
+        self.cache.invalidate(state)
+        self.random_index.mark_failing(state)
+
+    @staticmethod
+    def _token_from_row(row: Union[dict, None]) -> Union[dict, None]:
+        if row is None or row['access_token'] is None:
+            return None
+
+        return {
+            'access_token': row['access_token'],
+            'expires_on': int(row['timestamp_got_expires_in']) + int(row['expires_in']),
+            'nickname': row['nickname'],
+            'fid': row['fid']
+        }
+
+    def _count_usage(self, state: str) -> None:
+        if config.do_skip_token_usage_increment:
+            return
+
+        if config.usage_flush_interval > 0:
+            self.usages.increment(state)
+
+        else:
+            with self.db:
+                self.db.execute(sqlite_requests.increment_usages, {'state': state})
+
+    def get_token_for_user(self, state: str) -> dict:
+        token = self._token_from_row(self.get_row(state))
+        self._count_usage(state)
+        return token
+
+    def get_fresh_token_for_user(self, state: str, refresh_margin: int, count_usage: bool = True) -> Union[dict, None]:
+        """
+        Fast path of getting token: checks expiration, builds the token and counts usage by one query at most
+
+        :param state:
+        :param refresh_margin: token is not fresh if less than refresh_margin seconds left till its expiration
+        :param count_usage: False to only look at the token, e.g. to answer conditional request
+        :return: token, None if there is no such state or token has to be refreshed first
+        """
+
+        now = int(time.time())
+        row = self.cache.get_row(state)
+        if row is None and count_usage and not config.do_skip_token_usage_increment \
+                and config.usage_flush_interval <= 0:
+            # Not buffered usages, so check, count and fetch in one statement
+            with self.db:
+                rows = self.db.execute(
+                    sqlite_requests.increment_usages_if_fresh,
+                    {'state': state, 'refresh_margin': refresh_margin, 'now': now}
+                ).fetchall()
+
+            return rows[0] if len(rows) > 0 else None
+
+        if row is None:
+            generation = self.cache.generation
+            row = self.db.execute(sqlite_requests.select_all_by_state, {'state': state}).fetchone()
+            self.cache.put_row(row, generation)
+
+        token = self._token_from_row(row)
+        if token is None or token['expires_on'] - refresh_margin <= now:
+            return None
+
+        if count_usage:
+            self._count_usage(state)
+
+        return token
+
+    def _add_usages(self, usages: dict[str, int]) -> None:
+        with self.db:
+            self.db.executemany(
+                sqlite_requests.add_usages,
+                [{'state': state, 'count': count} for state, count in usages.items()]
+            )
+
+    def acquire_refresh_lock(self, state: str, ttl: float) -> Union[float, None]:
+        """
+        Try to take refresh lease for a state, it expires in ttl seconds in case if holder died
+
+        :param state:
+        :param ttl:
+        :return: lease identifier to release it later with, None if lease is held by someone else
+        """
+
+        now = time.time()
+        locked_until = now + ttl
+        with self.db:
+            cursor = self.db.execute(
+                sqlite_requests.acquire_refresh_lock,
+                {'state': state, 'locked_until': locked_until, 'now': now}
+            )
+
+        if cursor.rowcount == 1:
+            return locked_until
+
+        return None
+
+    def release_refresh_lock(self, state: str, locked_until: float) -> None:
+        with self.db:
+            self.db.execute(sqlite_requests.release_refresh_lock, {'state': state, 'locked_until': locked_until})
+
+    def get_states_due_refresh(self, deadline: int, max_tries: int, limit: int) -> list[str]:
+        """
+        Return states which tokens expire before deadline, sooner expiring first
+
+        :param deadline: unix timestamp
+        :param max_tries: skip rows with this or more failed refreshes
+        :param limit:
+        :return:
+        """
+        rows = self.db.execute(
+            sqlite_requests.select_states_due_refresh,
+            {'deadline': deadline, 'max_tries': max_tries, 'limit': limit}
+        ).fetchall()
+
+        return [row['state'] for row in rows]
+
+    def iter_valid_records(self, fields: list[str], after: str = '', limit: int = -1) -> Iterator[dict]:
+        """
+        Valid records ordered by state, read lazily from cursor
+
+        :param fields: columns to select, must be trusted
+        :param after: keyset pagination, return records with state greater than this one
+        :param limit: -1 for no limit
+        :return:
+        """
+        return self.db.execute(
+            sqlite_requests.select_valid_page.format(fields=', '.join(fields)),
+            {'after': after, 'limit': limit}
+        )
+
+    def get_valid_page_last_state(self, after: str, limit: int) -> Union[str, None]:
+        """
+        :return: state of last record of a page, None if the page isn't full
+        """
+        row = self.db.execute(sqlite_requests.select_valid_page_last_state, {'after': after, 'limit': limit}).fetchone()
+        if row is None:
+            return None
+
+        return row['state']
+
+    def list_all_valid_records(self) -> list:
+        return self.db.execute(sqlite_requests.select_nickname_state_all).fetchall()
+
+    def cleanup_orphans_records(self) -> None:
+        with self.db:
+            self.db.execute(sqlite_requests.del_orphans)
+
+        self.cache.clear()
+
+    def list_all_records(self) -> list[dict]:
+        return self.db.execute(sqlite_requests.select_all).fetchall()
+
+    def count_records(self) -> int:
+        return self.db.execute(sqlite_requests.count_all).fetchone()['count']
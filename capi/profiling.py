@@ -0,0 +1,122 @@
+import base64
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import threading
+
+from EDMCLogging import get_main_logger
+from process_local import ProcessLocal
+
+logger = get_main_logger()
+
+SORT_KEYS = ('cumulative', 'tottime', 'calls', 'ncalls')
+
+
+def _encode_route(route: str) -> str:
+    return base64.urlsafe_b64encode(route.encode('utf-8')).decode('utf-8')
+
+
+def _decode_route(encoded: str) -> str:
+    return base64.urlsafe_b64decode(encoded.encode('utf-8')).decode('utf-8')
+
+
+class RouteProfiles:
+    """
+    cProfile stats of sampled requests, aggregated per route.
+
+    Every process keeps its own stats and dumps routes which got new samples to `directory` as <route>.<pid>.prof
+    every dump_interval seconds, summary is built from files of all processes.
+    """
+
+    def __init__(self, directory: str, dump_interval: float):
+        self.directory = directory
+        self.dump_interval = dump_interval
+        self._lock = threading.Lock()
+        self._dump_lock = threading.Lock()  # dump thread and summary dump the same files
+        self._stats: dict[str, pstats.Stats] = dict()
+        self._dirty: set[str] = set()  # routes with samples which aren't dumped yet
+        self._process = ProcessLocal(
+            'profiles-dump', on_start=self._start, loop=self.dump, interval=dump_interval, at_exit=self.dump
+        )
+
+    def _file(self, route: str, pid: int) -> str:
+        return os.path.join(self.directory, f'{_encode_route(route)}.{pid}.prof')
+
+    def _start(self) -> None:
+        self._stats.clear()  # they belong to parent process
+        self._dirty.clear()
+
+    def add(self, route: str, profiler: cProfile.Profile) -> None:
+        with self._lock:
+            self._process.start()
+
+            stats = self._stats.get(route)
+            if stats is None:
+                self._stats[route] = pstats.Stats(profiler)
+
+            else:
+                stats.add(profiler)
+
+            self._dirty.add(route)
+
+    def dump(self) -> None:
+        with self._dump_lock:
+            with self._lock:
+                if not self._process.started:
+                    return  # nothing was sampled by this process
+
+                routes, self._dirty = self._dirty, set()
+                # marshal of stats dict is a snapshot, as add() can change it meanwhile
+                snapshots = {route: marshal.dumps(self._stats[route].stats) for route in routes}
+
+            for route, snapshot in snapshots.items():
+                try:
+                    os.makedirs(self.directory, exist_ok=True)
+                    tmp_file = self._file(route, self._process.pid) + '.tmp'
+                    with open(tmp_file, 'wb') as file:
+                        file.write(snapshot)  # the same format as pstats.Stats.dump_stats()
+
+                    os.replace(tmp_file, self._file(route, self._process.pid))
+
+                except Exception as e:
+                    logger.warning(f"Couldn't dump profile of {route!r}", exc_info=e)
+
+    def _files_by_route(self) -> dict[str, list[str]]:
+        files: dict[str, list[str]] = dict()
+        if not os.path.isdir(self.directory):
+            return files
+
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith('.prof'):
+                continue
+
+            encoded_route = file_name.split('.')[0]
+            files.setdefault(_decode_route(encoded_route), list()).append(os.path.join(self.directory, file_name))
+
+        return files
+
+    def routes(self) -> list[str]:
+        self.dump()
+        return sorted(self._files_by_route().keys())
+
+    def summary(self, route: str, top: int = 30, sort: str = 'cumulative') -> str:
+        """
+        Top functions of the route's profile of all processes
+
+        :param route: route template
+        :param top: amount of functions
+        :param sort: one of SORT_KEYS
+        :return: pstats report, empty string if there are no samples for the route
+        """
+
+        self.dump()
+        files = self._files_by_route().get(route)
+        if files is None:
+            return ''
+
+        output = io.StringIO()
+        stats = pstats.Stats(*files, stream=output)
+        stats.strip_dirs().sort_stats(sort).print_stats(top)
+        return output.getvalue()
@@ -0,0 +1,179 @@
+import random
+import sqlite3
+import threading
+from typing import Callable, Union
+
+import config
+from . import sqlite_requests
+from EDMCLogging import get_main_logger
+from process_local import ProcessLocal
+
+logger = get_main_logger()
+
+
+class RandomUserIndex:
+    """
+    Per process in memory index of valid users which refreshes aren't known to fail, for O(1) random pick.
+
+    Model keeps it updated on changes it makes. Changes made by other processes get in by a background thread every
+    `resync_interval` seconds: only states logged in authorizations_changes since the last sync are read from DB,
+    whole table is loaded only once per process (or if changes it hasn't seen were pruned already).
+    """
+
+    def __init__(self, connection: Callable[[], sqlite3.Connection], resync_interval: float):
+        """
+
+        :param connection: returns DB connection for the calling thread
+        :param resync_interval: seconds
+        """
+
+        self.connection = connection
+        self.resync_interval = resync_interval
+
+        self._lock = threading.Lock()
+        self._states: list[str] = list()
+        self._positions: dict[str, int] = dict()  # state -> index in self._states, for O(1) removal
+        self._usages: dict[str, int] = dict()
+        self._failing: set[str] = set()  # removed because of failed refresh, to be returned on successful one
+        self._last_change: Union[int, None] = None  # seq in authorizations_changes the index is synced up to
+        self._loaded = threading.Event()
+        # forked process keeps parent's index and goes on from parent's _last_change
+        self._process = ProcessLocal('random-index-sync', loop=self._sync, interval=resync_interval, wait_first=False)
+
+    def _sync(self) -> None:
+        try:
+            if self._last_change is None:
+                self._load()
+
+            else:
+                self._apply_changes()
+
+        except Exception as e:
+            logger.warning("Couldn't sync random users index", exc_info=e)
+
+        finally:
+            self._loaded.set()  # don't keep picks waiting if the first load failed, next sync will retry it
+
+    def _load(self) -> None:
+        db = self.connection()
+        # before rows, so changes made meanwhile get applied by the next sync
+        last_change = db.execute(sqlite_requests.select_last_change).fetchone()['seq']
+        rows = db.execute(sqlite_requests.select_random_candidates).fetchall()
+        states = [row['state'] for row in rows]
+        positions = {state: position for position, state in enumerate(states)}
+        usages = {row['state']: row['usages'] for row in rows}
+        with self._lock:
+            self._states, self._positions, self._usages = states, positions, usages
+            self._failing.clear()
+            self._last_change = last_change
+
+    def _apply_changes(self) -> None:
+        db = self.connection()
+        changes = db.execute(sqlite_requests.select_changes_since, {'seq': self._last_change}).fetchall()
+        if len(changes) > 0 and changes[0]['seq'] != self._last_change + 1:
+            self._load()  # changes we haven't seen were pruned already
+            return
+
+        with self._lock:
+            # failing ones are rechecked too, e.g. refresh could fail because of FDEV outage
+            states = list({change['state'] for change in changes} | self._failing)
+
+        candidates = dict()
+        for i in range(0, len(states), config.sqlite_max_variables):
+            chunk = states[i:i + config.sqlite_max_variables]
+            query = sqlite_requests.select_random_candidates_by_states.format(placeholders=', '.join('?' * len(chunk)))
+            candidates.update((row['state'], row['usages']) for row in db.execute(query, chunk).fetchall())
+
+        with self._lock:
+            for state in states:
+                self._failing.discard(state)
+                if state in candidates:
+                    self._add(state, candidates[state])
+
+                else:
+                    self._remove(state)
+
+            if len(changes) > 0:
+                self._last_change = changes[-1]['seq']
+
+    def _wait_loaded(self) -> None:
+        """
+        Process's first sync loads whole table, it's done by background thread, but the first picks have to wait for it
+        """
+
+        with self._lock:
+            self._process.start()
+
+        self._loaded.wait()
+
+    def add(self, state: str) -> None:
+        with self._lock:
+            self._failing.discard(state)
+            self._add(state, 0)
+
+    def _add(self, state: str, usages: int) -> None:
+        if state not in self._positions:
+            self._positions[state] = len(self._states)
+            self._states.append(state)
+            self._usages.setdefault(state, usages)
+
+    def remove(self, state: str) -> None:
+        with self._lock:
+            self._failing.discard(state)
+            self._remove(state)
+
+    def _remove(self, state: str) -> None:
+        position = self._positions.pop(state, None)
+        if position is None:
+            return
+
+        # move last state to the place of removed one
+        last_state = self._states.pop()
+        if last_state != state:
+            self._states[position] = last_state
+            self._positions[last_state] = position
+
+        self._usages.pop(state, None)
+
+    def mark_failing(self, state: str) -> None:
+        with self._lock:
+            if state in self._positions:
+                self._remove(state)
+                self._failing.add(state)
+
+    def mark_refreshed(self, state: str) -> None:
+        with self._lock:
+            is_failing = state in self._failing
+
+        if is_failing:
+            self.add(state)
+
+    def pick(self, least_used: bool = False, candidates: int = 2) -> Union[str, None]:
+        """
+        Random state
+
+        :param least_used: pick least used one of `candidates` random states
+        :param candidates:
+        :return: None if there are no users
+        """
+
+        self._wait_loaded()
+        with self._lock:
+            if len(self._states) == 0:
+                return None
+
+            if least_used:
+                state = min(
+                    (random.choice(self._states) for _ in range(candidates)),
+                    key=lambda _state: self._usages.get(_state, 0)
+                )
+
+            else:
+                state = random.choice(self._states)
+
+            self._usages[state] = self._usages.get(state, 0) + 1
+            return state
+
+    def __len__(self) -> int:
+        self._wait_loaded()
+        return len(self._states)
@@ -0,0 +1,160 @@
+import contextlib
+import os
+import threading
+import time
+from typing import Iterator, Union
+
+import config
+from . import db
+from . import exceptions
+from . import sqlite_requests
+from EDMCLogging import get_main_logger
+
+logger = get_main_logger()
+
+
+class UpstreamRateLimiter:
+    """
+    Token buckets for requests to FDEV, one per endpoint, shared by all processes and threads.
+
+    Buckets live in a separate SQLite DB, not in the main one: taking a token is a commit, and every commit to
+    the main DB makes TokenCache of all processes look for changed rows.
+
+    Requests made inside background() block, e.g. by refresh jobs, leave `reserves` tokens of the bucket to
+    interactive requests, such as logins. Background jobs wait() for a token before a request, as long as it takes.
+    """
+
+    def __init__(self, db_location: str, limits: dict[str, tuple[float, int]], max_wait: float,
+                 reserves: Union[dict[str, int], None] = None):
+        """
+
+        :param db_location:
+        :param limits: {endpoint: (requests per second, burst)}, endpoints with 0 rate aren't limited
+        :param max_wait: how long to wait for a token before giving up, seconds
+        :param reserves: {endpoint: tokens background requests don't take}, less than burst
+        """
+
+        self.db_location = db_location
+        self.limits = limits
+        self.max_wait = max_wait
+        self.reserves = dict() if reserves is None else reserves
+        self._background = threading.local()
+        self._connections: Union[db.ConnectionManager, None] = None
+        self._connections_lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        # connections opened before fork, e.g. by uwsgi master, must not be shared with the forked process
+        self._connections = None
+        self._connections_lock = threading.Lock()  # could be held by another thread of the parent at fork
+
+    @property
+    def db(self):
+        if self._connections is None:
+            with self._connections_lock:
+                if self._connections is None:
+                    # lazily, so uwsgi master doesn't open the DB before fork
+                    connections = db.ConnectionManager(self.db_location)
+                    with connections.get() as connection:
+                        connection.execute(sqlite_requests.upstream_buckets_schema)
+
+                    # only once the table exists, other threads skip the lock as soon as it's set
+                    self._connections = connections
+
+        return self._connections.get()
+
+    @contextlib.contextmanager
+    def background(self) -> Iterator[None]:
+        """
+        Requests of the calling thread inside the block are background ones, they don't take reserved tokens
+        """
+
+        previous = self.is_background
+        self._background.active = True
+        try:
+            yield
+
+        finally:
+            self._background.active = previous
+
+    @property
+    def is_background(self) -> bool:
+        return getattr(self._background, 'active', False)
+
+    def _params(self, endpoint: str) -> dict:
+        rate, burst = self.limits[endpoint]
+        reserve = min(self.reserves.get(endpoint, 0), burst - 1) if self.is_background else 0
+        return {'name': endpoint, 'rate': rate, 'burst': burst, 'reserve': reserve, 'now': time.time()}
+
+    @staticmethod
+    def _wait_time(bucket: Union[dict, None], params: dict) -> float:
+        tokens = 0 if bucket is None else bucket['tokens']
+        return max(0.0, (1 + params['reserve'] - tokens) / params['rate'])
+
+    def try_acquire(self, endpoint: str) -> float:
+        """
+        Take a token without waiting
+
+        :param endpoint: key of limits
+        :return: 0 if the token was taken, otherwise seconds until the next token
+        """
+
+        params = self._params(endpoint)
+        if params['rate'] <= 0:
+            return 0
+
+        with self.db:
+            if self.db.execute(sqlite_requests.take_upstream_token, params).fetchone() is not None:
+                return 0
+
+            bucket = self.db.execute(sqlite_requests.select_upstream_bucket, params).fetchone()
+
+        return self._wait_time(bucket, params)
+
+    def acquire(self, endpoint: str) -> None:
+        """
+        Take a token, wait up to max_wait for it
+
+        :param endpoint: key of limits
+        :return:
+        """
+
+        deadline = time.monotonic() + self.max_wait
+        while (wait := self.try_acquire(endpoint)) > 0:
+            if time.monotonic() + wait > deadline:
+                logger.warning(f'Upstream rate limit for {endpoint!r} is exhausted, retry after {wait:.1f}s')
+                raise exceptions.UpstreamThrottled(endpoint, wait)
+
+            time.sleep(wait)
+
+    def wait(self, endpoint: str) -> None:
+        """
+        Wait as long as it takes for a token to become available, without taking it. For background jobs, so they
+        wait before a refresh starts, not while holding its refresh lock
+
+        :param endpoint: key of limits
+        :return:
+        """
+
+        while True:
+            params = self._params(endpoint)
+            if params['rate'] <= 0:
+                return
+
+            bucket = self.db.execute(sqlite_requests.select_upstream_bucket, params).fetchone()
+            if bucket is None or (wait := self._wait_time(bucket, params)) <= 0:
+                return
+
+            time.sleep(wait)
+
+
+rate_limiter = UpstreamRateLimiter(
+    config.upstream_rate_limit_db,
+    {
+        'token': (config.upstream_rate_token, config.upstream_burst_token),
+        'me': (config.upstream_rate_me, config.upstream_burst_me),
+        'profile': (config.upstream_rate_profile, config.upstream_burst_profile)
+    },
+    config.upstream_rate_max_wait,
+    {'token': config.upstream_reserve_token}
+)
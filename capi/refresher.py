@@ -0,0 +1,199 @@
+import concurrent.futures
+import threading
+import time
+from collections import Counter
+from typing import Iterator
+
+import config
+from . import exceptions
+from .rate_limit import rate_limiter
+from EDMCLogging import get_main_logger
+
+logger = get_main_logger()
+
+
+def refresh_result(authorizer, state: str, **kwargs) -> tuple[str, str]:
+    """
+    Refresh by state without raising
+
+    :param authorizer: CAPIAuthorizer
+    :param state:
+    :param kwargs: for refresh_by_state
+    :return: (status, description)
+    """
+
+    try:
+        msg = authorizer.refresh_by_state(state, **kwargs)
+        return msg['status'], msg['description']
+
+    except exceptions.RefreshFail as e:
+        return e.status, e.message
+
+    except Exception as e:
+        logger.warning(f'Unexpected exception on refresh for {state!r}', exc_info=e)
+        return 'error', 'Unexpected exception'
+
+
+class ProactiveRefresher:
+    """
+    Refreshes tokens in background before they get into token_refresh_margin, so requests for tokens
+    don't have to wait for FDEV.
+
+    Must be run in exactly one process (see refresher.py), otherwise workers would fight for the same rows.
+    """
+
+    def __init__(
+            self,
+            authorizer,
+            lead: int = config.proactive_refresh_lead,
+            interval: int = config.proactive_refresh_interval,
+            concurrency: int = config.proactive_refresh_concurrency,
+            batch: int = config.proactive_refresh_batch,
+            max_tries: int = config.proactive_refresh_max_tries
+    ):
+        self.authorizer = authorizer
+        self.lead = lead
+        self.interval = interval
+        self.concurrency = concurrency
+        self.batch = batch
+        self.max_tries = max_tries
+
+    def _refresh_one(self, state: str) -> tuple[str, str]:
+        with rate_limiter.background():
+            rate_limiter.wait('token')
+            return refresh_result(self.authorizer, state, refresh_margin=config.token_refresh_margin + self.lead)
+
+    def run_once(self, executor: concurrent.futures.Executor) -> Counter:
+        """
+        Refresh one batch of due tokens, sooner expiring first
+
+        :param executor: executor to run refreshes in, its max_workers caps simultaneous refreshes
+        :return: Counter of (status, description) of refreshes results
+        """
+
+        deadline = int(time.time()) + config.token_refresh_margin + self.lead
+        states = self.authorizer.model.get_states_due_refresh(deadline, self.max_tries, self.batch)
+        # map() submits in order of expiration, so sooner expiring tokens get refreshed first
+        results = Counter(executor.map(self._refresh_one, states))
+
+        if len(states) > 0:
+            logger.info(f'Proactively refreshed {len(states)} tokens: {dict(results)!r}')
+
+        return results
+
+    def run_forever(self) -> None:
+        logger.info(f'Starting proactive refresher, lead: {self.lead}, concurrency: {self.concurrency}')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while True:
+                started = time.monotonic()
+                try:
+                    results = self.run_once(executor)
+
+                except Exception as e:
+                    logger.exception('Proactive refresh iteration failed', exc_info=e)
+                    results = Counter()
+
+                refreshed = sum(count for (status, _), count in results.items() if status == 'ok')
+                if refreshed >= self.batch:
+                    continue  # there are probably more due tokens, don't wait, unless refreshes are failing
+
+                time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+
+class RefreshAllJob:
+    """
+    Refreshes all valid tokens at once, e.g. to warm the table up after FDEV outage before traffic returns.
+
+    Refreshes are background ones for the shared upstream rate limit, so the job doesn't take tokens reserved for
+    logins. Tokens which don't need refresh (unless force_refresh) are skipped without waiting for a rate slot,
+    so `rate` caps only requests to FDEV.
+    """
+
+    def __init__(
+            self,
+            authorizer,
+            force_refresh: bool = False,
+            workers: int = config.refresh_all_workers,
+            rate: float = config.refresh_all_rate,
+            progress_every: int = 100
+    ):
+        """
+
+        :param authorizer: CAPIAuthorizer
+        :param force_refresh: refresh even tokens which aren't expiring
+        :param workers: simultaneous refreshes
+        :param rate: refreshes per second on top of the shared rate limit, 0 for no extra cap
+        :param progress_every: yield progress every this many tokens
+        """
+
+        self.authorizer = authorizer
+        self.force_refresh = force_refresh
+        self.workers = workers
+        self.rate = rate
+        self.progress_every = progress_every
+
+        self._rate_lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def _wait_rate_slot(self) -> None:
+        if self.rate <= 0:
+            return
+
+        with self._rate_lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + 1 / self.rate
+
+        time.sleep(slot - now)
+
+    def _refresh_one(self, state: str) -> tuple[str, str]:
+        msg = {'status': '', 'description': '', 'state': ''}
+        try:
+            row = self.authorizer.model.get_row(state)
+            if not self.authorizer._is_refresh_needed(
+                    row, state, msg, self.force_refresh, config.token_refresh_margin
+            ):
+                return msg['status'], msg['description']
+
+        except exceptions.RefreshFail as e:
+            return e.status, e.message
+
+        self._wait_rate_slot()
+        with rate_limiter.background():
+            rate_limiter.wait('token')
+            return refresh_result(self.authorizer, state, force_refresh=self.force_refresh)
+
+    def run(self) -> Iterator[dict]:
+        """
+        Refresh all valid tokens, yields progress as they get refreshed
+
+        :return: iterator of {'done': int, 'total': int, 'summary': {status: {description: count}}},
+        the last one is the final result
+        """
+
+        states = [row['state'] for row in self.authorizer.list_all_valid_users()]
+        results = Counter()
+        logger.info(f'Refreshing all {len(states)} tokens, force: {self.force_refresh}, workers: {self.workers}, '
+                    f'rate: {self.rate}')
+
+        def progress() -> dict:
+            summary = dict()
+            for (status, description), count in results.items():
+                summary.setdefault(status, dict())[description] = count
+
+            return {'done': sum(results.values()), 'total': len(states), 'summary': summary}
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='refresh-all')
+        try:
+            for done, result in enumerate(executor.map(self._refresh_one, states), start=1):
+                results[result] += 1
+                if done % self.progress_every == 0 and done != len(states):
+                    yield progress()
+
+        finally:
+            # don't keep refreshing if the consumer has gone away
+            executor.shutdown(cancel_futures=True)
+
+        final = progress()
+        logger.info(f'Refreshed all tokens: {final!r}')
+        yield final
@@ -0,0 +1,114 @@
+"""
+Response serializers for token routes, see web.negotiate_serializer.
+
+JSON is encoded by orjson if it's installed, otherwise by stdlib json. MessagePack is offered only if msgpack
+is installed.
+"""
+
+import json
+from typing import Any, Callable, NamedTuple, Union
+
+try:
+    import orjson
+
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+
+except ImportError:
+    msgpack = None
+
+MEDIA_JSON = 'application/json'
+MEDIA_MSGPACK = 'application/msgpack'
+MEDIA_X_MSGPACK = 'application/x-msgpack'
+
+
+class Serializer(NamedTuple):
+    content_type: str
+    dumps: Callable[[Any], bytes]
+    # to stream lists: (opening, separator, closing), None if the format streams items concatenated
+    list_framing: Union[tuple[bytes, bytes, bytes], None]
+
+
+def _dumps_json(obj: Any) -> bytes:
+    return json.dumps(obj).encode('utf-8')
+
+
+JSON = Serializer(MEDIA_JSON, _dumps_json if orjson is None else orjson.dumps, (b'[', b', ', b']'))
+
+SERIALIZERS: dict[str, Serializer] = {MEDIA_JSON: JSON}
+
+if msgpack is not None:
+    # there is no way to stream msgpack array of unknown length, so lists are streamed as concatenated maps
+    SERIALIZERS[MEDIA_MSGPACK] = Serializer(MEDIA_MSGPACK, msgpack.packb, None)
+    SERIALIZERS[MEDIA_X_MSGPACK] = Serializer(MEDIA_X_MSGPACK, msgpack.packb, None)
+
+
+def _parse_accept(accept: str) -> dict[str, float]:
+    """
+    :return: {media range: q}
+    """
+
+    ranges: dict[str, float] = dict()
+    for item in accept.split(','):
+        media_range, *params = item.split(';')
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+
+                except ValueError:
+                    q = 0.0
+
+        ranges[media_range.strip().lower()] = q
+
+    return ranges
+
+
+def _json_quality(ranges: dict[str, float]) -> float:
+    # the most specific range applies
+    for media_range in (MEDIA_JSON, 'application/*', '*/*'):
+        if media_range in ranges:
+            return ranges[media_range]
+
+    return 0.0
+
+
+def negotiate(accept: Union[str, None]) -> Serializer:
+    """
+    JSON unless Accept names MessagePack explicitly with q not lower than JSON's, so clients which accept
+    anything keep getting JSON. JSON is also the answer when the client accepts nothing we support.
+
+    >>> negotiate(None).content_type
+    'application/json'
+    >>> negotiate('*/*').content_type
+    'application/json'
+    >>> negotiate('text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8').content_type
+    'application/json'
+    >>> negotiate('application/msgpack;q=0.5, application/json').content_type
+    'application/json'
+    >>> negotiate('application/msgpack').content_type == (MEDIA_JSON if msgpack is None else MEDIA_MSGPACK)
+    True
+    >>> expected = MEDIA_JSON if msgpack is None else MEDIA_X_MSGPACK
+    >>> negotiate('application/json;q=0.5, application/x-msgpack').content_type == expected
+    True
+
+    :param accept: Accept header
+    :return:
+    """
+
+    if msgpack is None or not accept:
+        return JSON
+
+    ranges = _parse_accept(accept)
+    best, best_q = JSON, _json_quality(ranges)
+    for media_type in (MEDIA_MSGPACK, MEDIA_X_MSGPACK):
+        q = ranges.get(media_type, 0.0)
+        if q > 0 and (q > best_q or best is JSON and q == best_q):
+            best, best_q = SERIALIZERS[media_type], q
+
+    return best
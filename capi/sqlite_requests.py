@@ -1,61 +1,238 @@
-schema = """create table if not exists authorizations (
-    code_verifier text , 
-    state text, 
-    timestamp_init datetime default current_timestamp , 
-    code text, 
-    access_token text, 
-    refresh_token text, 
-    expires_in text, 
-    timestamp_got_expires_in text, 
-    nickname text,
-    refresh_tries int default 0,
-    usages int default 0,
-    fid text unique
-);"""
-
-insert_auth_init = """insert into authorizations 
-    (code_verifier, state) 
-    values 
-    (:code_verifier, :state);"""
-
-select_all_by_state = """select * from authorizations where state = :state;"""
-
-set_code_state = """update authorizations set code = :code where state = :state;"""
-
-delete_by_state = """delete from authorizations where state = :state;"""
-
-set_tokens_by_state = """update authorizations 
-set 
-    access_token = :access_token, 
-    refresh_token = :refresh_token, 
-    expires_in = :expires_in, 
-    timestamp_got_expires_in = :timestamp_got_expires_in, 
-    refresh_tries = 0
-where state = :state;"""
-
-set_fid_by_state = """update authorizations set fid = :fid where state = :state;"""
-
-set_nickname_by_state = "update authorizations set nickname = :nickname where state = :state;"
-
-get_state_by_nickname = """select state from authorizations where nickname = :nickname;"""
-
-get_state_by_fid = """select state from authorizations where fid = :fid;"""
-
-update_state_by_state = """update authorizations set state = :new_state where state = :state;"""
-
-refresh_times_increment = """update authorizations set refresh_tries = refresh_tries + 1 where state = :state;"""
-
-get_token_for_user = """select 
-    access_token, 
-    timestamp_got_expires_in + expires_in as expires_on, 
-    nickname,
-    fid 
-from authorizations where state = :state;"""
-
-select_nickname_state_all = """select nickname, fid, state from authorizations where fid is not null;"""
-
-del_orphans = """delete from authorizations where fid is null;"""
-
-increment_usages = "update authorizations set usages = usages + 1 where state = :state;"
-
-select_all = """select * from authorizations;"""
+schema = """create table if not exists authorizations (
+    code_verifier text , 
+    state text, 
+    timestamp_init datetime default current_timestamp , 
+    code text, 
+    access_token text, 
+    refresh_token text, 
+    expires_in text, 
+    timestamp_got_expires_in text, 
+    nickname text,
+    refresh_tries int default 0,
+    usages int default 0,
+    fid text unique
+);"""
+
+refresh_locks_schema = """create table if not exists refresh_locks (
+    state text primary key,
+    locked_until real
+);"""
+
+insert_auth_init = """insert into authorizations 
+    (code_verifier, state) 
+    values 
+    (:code_verifier, :state);"""
+
+select_all_by_state = """select * from authorizations where state = :state;"""
+
+# bulk queries, {placeholders} is to be replaced with ?, ... for every value
+select_all_by_states = """select * from authorizations where state in ({placeholders});"""
+
+select_all_by_fids = """select * from authorizations where fid in ({placeholders});"""
+
+select_all_by_nicknames = """select * from authorizations where nickname collate nocase in ({placeholders});"""
+
+delete_by_states = """delete from authorizations where state in ({placeholders});"""
+
+delete_by_state = """delete from authorizations where state = :state;"""
+
+set_tokens_by_state = """update authorizations 
+set 
+    access_token = :access_token, 
+    refresh_token = :refresh_token, 
+    expires_in = :expires_in, 
+    timestamp_got_expires_in = :timestamp_got_expires_in, 
+    refresh_tries = 0
+where state = :state;"""
+
+select_other_state_by_fid = """select state, nickname from authorizations where fid = :fid and state != :state;"""
+
+save_login_by_state = """update authorizations 
+set 
+    state = :new_state,
+    code = :code,
+    access_token = :access_token, 
+    refresh_token = :refresh_token, 
+    expires_in = :expires_in, 
+    timestamp_got_expires_in = :timestamp_got_expires_in, 
+    refresh_tries = 0,
+    nickname = :nickname,
+    fid = :fid
+where state = :state;"""
+
+set_nickname_by_fid = "update authorizations set nickname = :nickname where fid = :fid returning state;"
+
+select_all_by_nickname = """select * from authorizations where nickname = :nickname collate nocase;"""
+
+select_all_by_fid = """select * from authorizations where fid = :fid;"""
+
+refresh_times_increment = """update authorizations set refresh_tries = refresh_tries + 1 where state = :state;"""
+
+select_states_due_refresh = """select state from authorizations 
+where 
+    fid is not null and 
+    refresh_tries < :max_tries and 
+    timestamp_got_expires_in + expires_in < :deadline
+order by timestamp_got_expires_in + expires_in
+limit :limit;"""
+
+select_nickname_state_all = """select nickname, fid, state from authorizations where fid is not null;"""
+
+# {fields} is to be replaced with comma separated columns names
+select_valid_page = """select {fields} from authorizations 
+where fid is not null and state > :after 
+order by state
+limit :limit;"""
+
+select_valid_page_last_state = """select state from authorizations 
+where fid is not null and state > :after 
+order by state
+limit 1 offset :limit - 1;"""
+
+select_random_candidates = """select state, usages from authorizations 
+where fid is not null and access_token is not null and refresh_tries = 0;"""
+
+select_random_candidates_by_states = """select state, usages from authorizations 
+where state in ({placeholders}) and fid is not null and access_token is not null and refresh_tries = 0;"""
+
+del_orphans = """delete from authorizations where fid is null;"""
+
+increment_usages = "update authorizations set usages = usages + 1 where state = :state;"
+
+increment_usages_if_fresh = """update authorizations set usages = usages + 1 
+where state = :state and timestamp_got_expires_in + expires_in - :refresh_margin > :now
+returning
+    access_token, 
+    timestamp_got_expires_in + expires_in as expires_on, 
+    nickname,
+    fid;"""
+
+add_usages = "update authorizations set usages = usages + :count where state = :state;"
+
+count_all = """select count(*) as count from authorizations;"""
+
+select_all = """select * from authorizations;"""
+
+acquire_refresh_lock = """insert into refresh_locks (state, locked_until) 
+values (:state, :locked_until)
+on conflict (state) do update set locked_until = excluded.locked_until where refresh_locks.locked_until < :now;"""
+
+release_refresh_lock = """delete from refresh_locks where state = :state and locked_until = :locked_until;"""
+
+# Upstream rate limiter's token buckets, they live in separate DB, see rate_limit.py
+upstream_buckets_schema = """create table if not exists upstream_buckets (
+    name text primary key,
+    tokens real,
+    updated real
+);"""
+
+# takes one token if there are more than :reserve after refill, returns nothing otherwise
+take_upstream_token = """insert into upstream_buckets (name, tokens, updated) 
+values (:name, :burst - 1, :now)
+on conflict (name) do update set 
+    tokens = min(:burst, tokens + max(0, :now - updated) * :rate) - 1, 
+    updated = max(updated, :now)
+where min(:burst, tokens + max(0, :now - updated) * :rate) >= 1 + :reserve
+returning tokens;"""
+
+select_upstream_bucket = """select min(:burst, tokens + max(0, :now - updated) * :rate) as tokens 
+from upstream_buckets where name = :name;"""
+
+# Migrations, see migrations.py
+# v2: typed columns and indexes, authorizations table gets rebuilt online, changes made to old table during
+# backfill are mirrored to new one by triggers
+
+authorizations_columns = """code_verifier, state, timestamp_init, code, access_token, refresh_token, expires_in, 
+    timestamp_got_expires_in, nickname, refresh_tries, usages, fid"""
+
+v2_schema = """create table authorizations_v2 (
+    code_verifier text, 
+    state text, 
+    timestamp_init datetime default current_timestamp, 
+    code text, 
+    access_token text, 
+    refresh_token text, 
+    expires_in integer, 
+    timestamp_got_expires_in integer, 
+    nickname text,
+    refresh_tries integer default 0,
+    usages integer default 0,
+    fid text unique
+);"""
+
+v2_cleanup = [
+    """drop trigger if exists authorizations_v2_insert;""",
+    """drop trigger if exists authorizations_v2_update;""",
+    """drop trigger if exists authorizations_v2_delete;""",
+    """drop table if exists authorizations_v2;"""
+]
+
+_v2_mirror_values = """new.rowid, new.code_verifier, new.state, new.timestamp_init, new.code, new.access_token, 
+    new.refresh_token, cast(new.expires_in as integer), cast(new.timestamp_got_expires_in as integer), new.nickname, 
+    new.refresh_tries, new.usages, new.fid"""
+
+v2_triggers = [
+    f"""create trigger authorizations_v2_insert after insert on authorizations begin
+    insert or replace into authorizations_v2 (rowid, {authorizations_columns}) values ({_v2_mirror_values});
+end;""",
+    f"""create trigger authorizations_v2_update after update on authorizations begin
+    insert or replace into authorizations_v2 (rowid, {authorizations_columns}) values ({_v2_mirror_values});
+end;""",
+    """create trigger authorizations_v2_delete after delete on authorizations begin
+    delete from authorizations_v2 where rowid = old.rowid;
+end;"""
+]
+
+v2_backfill_batch_end = """select rowid from authorizations 
+where rowid > :last_rowid order by rowid limit 1 offset :batch_size - 1;"""
+
+# "or ignore" so we don't overwrite rows which were already mirrored by triggers, they are newer
+v2_backfill = f"""insert or ignore into authorizations_v2 (rowid, {authorizations_columns}) 
+select 
+    rowid, code_verifier, state, timestamp_init, code, access_token, refresh_token, 
+    cast(expires_in as integer), cast(timestamp_got_expires_in as integer), nickname, refresh_tries, usages, fid 
+from authorizations 
+where rowid > :last_rowid and (:end_rowid is null or rowid <= :end_rowid);"""
+
+v2_swap = [
+    """drop trigger authorizations_v2_insert;""",
+    """drop trigger authorizations_v2_update;""",
+    """drop trigger authorizations_v2_delete;""",
+    """drop table authorizations;""",
+    """alter table authorizations_v2 rename to authorizations;""",
+    """create index authorizations_state on authorizations (state);""",
+    """create index authorizations_nickname on authorizations (nickname collate nocase);""",
+    """create index authorizations_expires_on on authorizations (timestamp_got_expires_in + expires_in);"""
+]
+
+# v3: log of changed states, so TokenCache of every process invalidates only changed rows, see cache.py.
+# Usages aren't logged, they aren't cached. Only last 10000 changes are kept, a cache which fell behind further
+# gets cleared whole.
+v3_changes_schema = """create table if not exists authorizations_changes (
+    seq integer primary key autoincrement,
+    state text
+);"""
+
+v3_changes_triggers = [
+    """create trigger if not exists authorizations_changes_insert after insert on authorizations begin
+    insert into authorizations_changes (state) values (new.state);
+end;""",
+    """create trigger if not exists authorizations_changes_update after update of 
+    code_verifier, state, timestamp_init, code, access_token, refresh_token, expires_in, timestamp_got_expires_in, 
+    nickname, refresh_tries, fid 
+on authorizations begin
+    insert into authorizations_changes (state) select old.state union select new.state;
+end;""",
+    """create trigger if not exists authorizations_changes_delete after delete on authorizations begin
+    insert into authorizations_changes (state) values (old.state);
+end;""",
+    """create trigger if not exists authorizations_changes_prune after insert on authorizations_changes begin
+    delete from authorizations_changes where seq <= new.seq - 10000;
+end;"""
+]
+
+select_data_version = """pragma data_version;"""
+
+select_last_change = """select coalesce(max(seq), 0) as seq from authorizations_changes;"""
+
+select_changes_since = """select seq, state from authorizations_changes where seq > :seq order by seq;"""
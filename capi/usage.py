@@ -0,0 +1,70 @@
+import threading
+from collections import Counter
+from typing import Callable
+
+from EDMCLogging import get_main_logger
+from process_local import ProcessLocal
+
+logger = get_main_logger()
+
+
+class UsageCounter:
+    """
+    Buffers tokens usages increments in memory and flushes them to DB in one transaction
+    every `interval` seconds and at exit.
+
+    If pending increments reach `max_pending`, they get flushed by the incrementing thread right away,
+    so no more than `max_pending` increments can be lost if the process gets killed.
+    """
+
+    def __init__(self, flush_callback: Callable[[dict[str, int]], None], interval: float, max_pending: int):
+        """
+
+        :param flush_callback: writes {state: increment} to DB
+        :param interval:
+        :param max_pending:
+        """
+
+        self.flush_callback = flush_callback
+        self.interval = interval
+        self.max_pending = max_pending
+
+        self._lock = threading.Lock()
+        self._pending: Counter = Counter()
+        self._pending_total = 0
+        self._process = ProcessLocal(
+            'usages-flush', on_start=self._start, loop=self.flush, interval=interval, at_exit=self.flush
+        )
+
+    def increment(self, state: str) -> None:
+        with self._lock:
+            self._process.start()
+
+            self._pending[state] += 1
+            self._pending_total += 1
+            flush_now = self._pending_total >= self.max_pending
+
+        if flush_now:
+            self.flush()
+
+    def _start(self) -> None:
+        self._pending.clear()  # they belong to parent process
+        self._pending_total = 0
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._pending_total == 0:
+                return
+
+            pending = self._pending
+            self._pending = Counter()
+            self._pending_total = 0
+
+        try:
+            self.flush_callback(dict(pending))
+
+        except Exception as e:
+            logger.warning(f"Couldn't flush {sum(pending.values())} usages increments, will retry", exc_info=e)
+            with self._lock:
+                self._pending.update(pending)
+                self._pending_total += sum(pending.values())
@@ -1,84 +1,163 @@
-import hashlib
-import base64
-from typing import Union
-
-from EDMCLogging import get_main_logger
-import requests
-import config
-
-logger = get_main_logger()
-
-
-def get_tokens_request(code, code_verifier) -> requests.Response:
-    """
-    Performs initial requesting access and refresh tokens
-
-    :param code:
-    :param code_verifier:
-    :return:
-    """
-    token_request: requests.Response = requests.post(
-        url=config.TOKEN_URL,
-        headers=
-        {
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'User-Agent': config.PROPER_USER_AGENT
-        },
-        data=f'redirect_uri={config.REDIRECT_URL}&'
-             f'code={code}&'
-             f'grant_type=authorization_code&'
-             f'code_verifier={code_verifier}&'
-             f'client_id={config.CLIENT_ID}')
-
-    return token_request
-
-
-def get_nickname(access_token: str) -> Union[str, None]:
-    nickname = None
-    try:
-        nickname = requests.get(
-            url='https://companion.orerve.net/profile',
-            headers=
-            {
-                'Authorization': f'Bearer {access_token}',
-                'User-Agent': config.PROPER_USER_AGENT
-            }
-        ).json()["commander"]["name"]
-
-    except Exception as e:
-        logger.warning(f"Couldn't get or set nickname", exc_info=e)
-
-    return nickname
-
-
-def get_fid(access_token: str) -> str:
-    fid = None
-    try:
-        fid = requests.get(
-            url='https://auth.frontierstore.net/me',
-            headers={
-                'Authorization': f'Bearer {access_token}',
-                'User-Agent': config.PROPER_USER_AGENT
-            }
-        ).json()["customer_id"]
-
-    except Exception as e:
-        logger.exception(f"Couldn't get FID", exc_info=e)
-
-    return fid
-
-
-def refresh_request(refresh_token: str) -> requests.Response:
-    return requests.post(
-        url=config.TOKEN_URL,
-        headers={'Content-Type': 'application/x-www-form-urlencoded'},
-        data=f'grant_type=refresh_token&client_id={config.CLIENT_ID}&refresh_token={refresh_token}')
-
-
-def generate_challenge(_verifier: bytes) -> str:
-    """
-    It takes code verifier and return code challenge
-    :param _verifier:
-    :return:
-    """
-    return base64.urlsafe_b64encode(hashlib.sha256(_verifier).digest())[:-1].decode('utf-8')
+import hashlib
+import base64
+import os
+from typing import Union
+
+from EDMCLogging import get_main_logger
+import requests
+import requests.adapters
+import config
+from .metrics import metrics, UPSTREAM_REQUEST_SECONDS
+from .rate_limit import rate_limiter
+
+logger = get_main_logger()
+
+
+def _build_session() -> requests.Session:
+    """
+    Builds keep-alive session for upstream (FDEV) calls, so we don't pay TLS handshake on every request
+
+    :return:
+    """
+    _session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=config.upstream_pool_connections,
+        pool_maxsize=config.upstream_pool_maxsize,
+        pool_block=True  # don't open more than pool_maxsize connections per host, wait for free one instead
+    )
+    _session.mount('https://', adapter)
+    _session.mount('http://', adapter)
+    return _session
+
+
+_session: Union[requests.Session, None] = None
+_session_pid = None
+
+
+def get_session() -> requests.Session:
+    """
+    Session of the current process, pooled connections must not be shared with forked processes
+
+    :return:
+    """
+
+    global _session, _session_pid
+    if _session_pid != os.getpid():
+        _session = _build_session()
+        _session_pid = os.getpid()
+
+    return _session
+
+
+def _request(endpoint: str, method: str, **kwargs) -> requests.Response:
+    """
+    Request to FDEV which gets measured
+
+    :param endpoint: token, me or profile
+    :param method:
+    :param kwargs: for session.request
+    :return:
+    """
+
+    with metrics.timer(UPSTREAM_REQUEST_SECONDS, {'endpoint': endpoint, 'status': 'error'}) as labels:
+        response = get_session().request(method, timeout=config.upstream_timeout, **kwargs)
+        labels['status'] = str(response.status_code)
+        return response
+
+
+def get_tokens_request(code, code_verifier) -> requests.Response:
+    """
+    Performs initial requesting access and refresh tokens
+
+    :param code:
+    :param code_verifier:
+    :return:
+    """
+    rate_limiter.acquire('token')
+    token_request: requests.Response = _request(
+        'token',
+        'POST',
+        url=config.TOKEN_URL,
+        headers=
+        {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'User-Agent': config.PROPER_USER_AGENT
+        },
+        data=f'redirect_uri={config.REDIRECT_URL}&'
+             f'code={code}&'
+             f'grant_type=authorization_code&'
+             f'code_verifier={code_verifier}&'
+             f'client_id={config.CLIENT_ID}')
+
+    return token_request
+
+
+def get_nickname(access_token: str) -> Union[str, None]:
+    nickname = None
+    try:
+        rate_limiter.acquire('profile')
+        nickname = _request(
+            'profile',
+            'GET',
+            url=config.PROFILE_URL,
+            headers=
+            {
+                'Authorization': f'Bearer {access_token}',
+                'User-Agent': config.PROPER_USER_AGENT
+            }
+        ).json()["commander"]["name"]
+
+    except Exception as e:
+        logger.warning(f"Couldn't get or set nickname", exc_info=e)
+
+    return nickname
+
+
+def get_fid(access_token: str) -> str:
+    """
+    :raises exceptions.UpstreamThrottled: unlike get_nickname, as login can't be completed without FID
+    """
+
+    rate_limiter.acquire('me')
+    fid = None
+    try:
+        fid = _request(
+            'me',
+            'GET',
+            url=config.ME_URL,
+            headers={
+                'Authorization': f'Bearer {access_token}',
+                'User-Agent': config.PROPER_USER_AGENT
+            }
+        ).json()["customer_id"]
+
+    except Exception as e:
+        logger.exception(f"Couldn't get FID", exc_info=e)
+
+    return fid
+
+
+REFRESH_REQUEST_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+
+def refresh_request_body(refresh_token: str) -> str:
+    return f'grant_type=refresh_token&client_id={config.CLIENT_ID}&refresh_token={refresh_token}'
+
+
+def refresh_request(refresh_token: str) -> requests.Response:
+    rate_limiter.acquire('token')
+    return _request(
+        'token',
+        'POST',
+        url=config.TOKEN_URL,
+        headers=REFRESH_REQUEST_HEADERS,
+        data=refresh_request_body(refresh_token))
+
+
+def generate_challenge(_verifier: bytes) -> str:
+    """
+    It takes code verifier and return code challenge
+    :param _verifier:
+    :return:
+    """
+    return base64.urlsafe_b64encode(hashlib.sha256(_verifier).digest())[:-1].decode('utf-8')
@@ -1,33 +1,131 @@
-import os
-
-import requests
-from os import getenv
-
-CLIENT_ID = getenv('client_id')
-assert CLIENT_ID, "No client_id in env"
-
-do_skip_token_usage_increment = os.getenv('SKIP_INCREMENT', 'false').lower() in ('true', 't', '1')
-
-log_level = os.getenv('LOG_LEVEL', 'DEBUG').upper()
-
-access_key = os.getenv('access_key')
-
-db_location = os.getenv('db_location', 'companion-api.sqlite')
-default_failure_tolerance = os.getenv('default_failure_tolerance', 'True').lower() == 'true'
-REDIRECT_URL = requests.utils.quote(os.getenv('REDIRECT_URL', ''))
-AUTH_URL = 'https://auth.frontierstore.net/auth'
-TOKEN_URL = 'https://auth.frontierstore.net/token'
-PROPER_USER_AGENT = 'EDCD-a31-0.3'
-REDIRECT_HTML_TEMPLATE = """
-<!DOCTYPE HTML>
-<html>
-    <head>
-        <meta http-equiv="refresh" content="0; url={link}">
-    </head>
-    <body>
-        <a href="{link}">
-            You should be redirected shortly...
-        </a>
-    </body>
-</html>
-"""
+import os
+import tempfile
+from os import getenv
+from urllib.parse import quote
+
+CLIENT_ID = getenv('client_id')
+assert CLIENT_ID, "No client_id in env"
+
+do_skip_token_usage_increment = os.getenv('SKIP_INCREMENT', 'false').lower() in ('true', 't', '1')
+# Usages increments are buffered in memory and written every usage_flush_interval seconds, 0 to write on every usage,
+# no more than usage_max_pending increments per worker are buffered (so can be lost on crash)
+usage_flush_interval = float(os.getenv('usage_flush_interval', '10'))
+usage_max_pending = int(os.getenv('usage_max_pending', '1000'))
+
+log_level = os.getenv('LOG_LEVEL', 'DEBUG').upper()
+# If non-zero, logs are written by a background thread, records which don't fit in the queue of this size get dropped
+log_queue_size = int(os.getenv('log_queue_size', '0'))
+
+access_key = os.getenv('access_key')
+
+db_location = os.getenv('db_location', 'companion-api.sqlite')
+default_failure_tolerance = os.getenv('default_failure_tolerance', 'True').lower() == 'true'
+
+# Token is refreshed when less than token_refresh_margin seconds left till its expiration
+token_refresh_margin = int(os.getenv('token_refresh_margin', '400'))
+
+# Background refresher (see refresher.py), refreshes tokens proactive_refresh_lead seconds before they get into token_refresh_margin
+proactive_refresh_lead = int(os.getenv('proactive_refresh_lead', '600'))
+proactive_refresh_interval = int(os.getenv('proactive_refresh_interval', '30'))
+proactive_refresh_concurrency = int(os.getenv('proactive_refresh_concurrency', '4'))
+proactive_refresh_batch = int(os.getenv('proactive_refresh_batch', '200'))
+proactive_refresh_max_tries = int(os.getenv('proactive_refresh_max_tries', '3'))  # leave failing ones to lazy refresh
+
+# Refresh of one state is done by one thread at time, others wait for it up to refresh_wait_timeout seconds
+refresh_wait_timeout = float(os.getenv('refresh_wait_timeout', '15'))
+refresh_lock_ttl = float(os.getenv('refresh_lock_ttl', '60'))  # in case if refreshing process died
+
+# SQLite tuning, see https://www.sqlite.org/pragma.html
+sqlite_busy_timeout = int(os.getenv('sqlite_busy_timeout', '5000'))  # milliseconds
+sqlite_synchronous = os.getenv('sqlite_synchronous', 'NORMAL').upper()  # NORMAL is safe in WAL mode
+sqlite_cache_size = int(os.getenv('sqlite_cache_size', '-16000'))  # negative means KiB, positive - pages
+sqlite_mmap_size = int(os.getenv('sqlite_mmap_size', '67108864'))  # bytes, 0 to disable
+sqlite_max_variables = 500  # per query, for bulk queries
+
+# Rows copied per transaction when migration rebuilds a table
+migration_batch_size = int(os.getenv('migration_batch_size', '5000'))
+
+# Max amount of rows kept by per process token cache, 0 to disable
+token_cache_size = int(os.getenv('token_cache_size', '100000'))
+
+# FDEV callback does /me and /profile lookups concurrently, fid is waited for up to callback_lookup_timeout,
+# nickname for up to callback_nickname_grace more after that, if it's slower, it gets set later.
+# callback_lookup_workers is per lookup kind, /me and /profile have separate pools
+callback_lookup_timeout = float(os.getenv('callback_lookup_timeout', '10'))
+callback_nickname_grace = float(os.getenv('callback_nickname_grace', '1'))
+callback_lookup_workers = int(os.getenv('callback_lookup_workers', '8'))
+
+# Per process index of users for /random_token, picks up changes made by other processes this often, seconds.
+# It's done by a background thread and reads only states changed since the previous resync
+random_index_resync_interval = float(os.getenv('random_index_resync_interval', '10'))
+
+# Bulk tokens requests
+bulk_max_items = int(os.getenv('bulk_max_items', '500'))
+bulk_refresh_workers = int(os.getenv('bulk_refresh_workers', '8'))
+
+# Refresh all job (/tools/refresh-all and refresh_all.py). Its refreshes are background ones for the shared 'token'
+# rate limit, see upstream_reserve_token, refresh_all_rate only caps the job further
+refresh_all_workers = int(os.getenv('refresh_all_workers', '8'))
+refresh_all_rate = float(os.getenv('refresh_all_rate', '0'))  # refreshes per second, 0 for no extra cap
+
+# ASGI mode (web_asgi.py)
+asgi_db_workers = int(os.getenv('asgi_db_workers', '4'))
+asgi_blocking_workers = int(os.getenv('asgi_blocking_workers', '8'))  # for login callbacks
+asgi_upstream_max_connections = int(os.getenv('asgi_upstream_max_connections', '100'))
+
+# Upstream (FDEV) HTTP client, one keep-alive pool per worker
+upstream_timeout = float(os.getenv('upstream_timeout', '10'))
+upstream_pool_connections = int(os.getenv('upstream_pool_connections', '2'))  # amount of hosts to keep pools for
+upstream_pool_maxsize = int(os.getenv('upstream_pool_maxsize', '10'))  # max connections per host
+
+# Upstream (FDEV) rate limits shared by all processes, requests per second and burst per endpoint, 0 rate for no limit.
+# Callers wait for a slot up to upstream_rate_max_wait seconds, then get "try later"
+upstream_rate_limit_db = os.getenv('upstream_rate_limit_db', db_location + '-ratelimit')
+upstream_rate_token = float(os.getenv('upstream_rate_token', '10'))
+upstream_burst_token = int(os.getenv('upstream_burst_token', '20'))
+upstream_rate_me = float(os.getenv('upstream_rate_me', '5'))
+upstream_burst_me = int(os.getenv('upstream_burst_me', '10'))
+upstream_rate_profile = float(os.getenv('upstream_rate_profile', '5'))
+upstream_burst_profile = int(os.getenv('upstream_burst_profile', '10'))
+upstream_rate_max_wait = float(os.getenv('upstream_rate_max_wait', '2'))
+# Tokens of the 'token' bucket left to logins and refreshes on request: background refreshes (proactive refresher and
+# refresh all job) take only tokens above it, waiting for them as long as it takes, so they can't starve logins
+upstream_reserve_token = int(os.getenv('upstream_reserve_token', '10'))
+
+# /metrics, every process dumps its metrics to its own file in metrics_dir every metrics_flush_interval seconds
+metrics_dir = os.getenv('metrics_dir', os.path.join(tempfile.gettempdir(), 'capi-metrics'))
+metrics_flush_interval = float(os.getenv('metrics_flush_interval', '5'))
+
+# Profiling of profiling_sample_rate share of requests and requests with profiling_header and access_key, WSGI only.
+# Per route profiles are dumped to profiling_dir every profiling_dump_interval seconds, see /tools/profiles
+profiling = os.getenv('profiling', 'false').lower() in ('true', 't', '1')
+profiling_sample_rate = float(os.getenv('profiling_sample_rate', '0.01'))
+profiling_header = os.getenv('profiling_header', 'X-Profile')
+profiling_dir = os.getenv('profiling_dir', os.path.join(tempfile.gettempdir(), 'capi-profiles'))
+profiling_dump_interval = float(os.getenv('profiling_dump_interval', '10'))
+
+# Refreshes are short-circuited for circuit_cooldown seconds after circuit_failure_threshold FDEV maintenance (418)
+# responses or connection errors in a row, still valid tokens are served meanwhile even if they are due refresh
+circuit_failure_threshold = int(os.getenv('circuit_failure_threshold', '5'))
+circuit_cooldown = float(os.getenv('circuit_cooldown', '30'))
+
+REDIRECT_URL = quote(os.getenv('REDIRECT_URL', ''))
+# overridable for benchmarks, see benchmarks/fdev_stub.py
+AUTH_URL = os.getenv('AUTH_URL', 'https://auth.frontierstore.net/auth')
+TOKEN_URL = os.getenv('TOKEN_URL', 'https://auth.frontierstore.net/token')
+ME_URL = os.getenv('ME_URL', 'https://auth.frontierstore.net/me')
+PROFILE_URL = os.getenv('PROFILE_URL', 'https://companion.orerve.net/profile')
+PROPER_USER_AGENT = 'EDCD-a31-0.3'
+REDIRECT_HTML_TEMPLATE = """
+<!DOCTYPE HTML>
+<html>
+    <head>
+        <meta http-equiv="refresh" content="0; url={link}">
+    </head>
+    <body>
+        <a href="{link}">
+            You should be redirected shortly...
+        </a>
+    </body>
+</html>
+"""
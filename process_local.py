@@ -0,0 +1,82 @@
+"""
+Per process part of long living objects.
+
+uwsgi imports the app in the master and forks workers from it, and only the forking thread survives fork, so
+background threads and the state they work on have to be set up lazily by every process which uses them.
+
+It's a top level module, unlike capi.utils, as EDMCLogging and capi.metrics need it and capi.utils imports both.
+"""
+
+import atexit
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+
+class ProcessLocal:
+    """
+    Calls `on_start` on the first start() in every process, e.g. to drop state inherited from the parent process, then
+    calls `loop` every `interval` seconds by a daemon thread of that process, right away too unless `wait_first`.
+    `at_exit` is called at exit of processes which started it.
+    """
+
+    def __init__(self, name: str, on_start: Optional[Callable[[], None]] = None,
+                 loop: Optional[Callable[[], None]] = None, interval: Optional[float] = None,
+                 at_exit: Optional[Callable[[], None]] = None, wait_first: bool = True):
+        """
+
+        :param name: name of the thread
+        :param on_start:
+        :param loop: callback of the thread, it should handle its exceptions, as the thread stops on the first one
+        :param interval: seconds, required with `loop`
+        :param at_exit:
+        :param wait_first: if the first `loop` call is in `interval` seconds, not right after start
+        """
+
+        self.name = name
+        self.on_start = on_start
+        self.loop = loop
+        self.interval = interval
+        self.at_exit = at_exit
+        self.wait_first = wait_first
+        self.pid: Optional[int] = None
+
+        if at_exit is not None:
+            atexit.register(self._at_exit)
+
+    @property
+    def started(self) -> bool:
+        """
+        If start() was called in the current process
+        """
+
+        return self.pid == os.getpid()
+
+    def start(self) -> None:
+        """
+        Starts it in the current process, if it isn't started yet. Isn't thread safe, call it under the lock which
+        guards the state on_start resets
+        """
+
+        if self.started:
+            return
+
+        self.pid = os.getpid()
+        if self.on_start is not None:
+            self.on_start()
+
+        if self.loop is not None:
+            threading.Thread(target=self._loop, name=self.name, daemon=True).start()
+
+    def _loop(self) -> None:
+        if not self.wait_first:
+            self.loop()
+
+        while True:
+            time.sleep(self.interval)
+            self.loop()
+
+    def _at_exit(self) -> None:
+        if self.started:
+            self.at_exit()
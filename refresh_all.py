@@ -0,0 +1,23 @@
+"""
+Refreshes all valid tokens, e.g. to warm the table up after FDEV outage before traffic returns:
+    python3 refresh_all.py [--force] [--workers N] [--rate R]
+
+The same is available as POST /tools/refresh-all
+"""
+
+import argparse
+import json
+
+import config
+from capi import capi_authorizer
+from capi.refresher import RefreshAllJob
+
+parser = argparse.ArgumentParser(description='Refresh all valid tokens')
+parser.add_argument('--force', action='store_true', help="refresh even tokens which aren't expiring")
+parser.add_argument('--workers', type=int, default=config.refresh_all_workers, help='simultaneous refreshes')
+parser.add_argument('--rate', type=float, default=config.refresh_all_rate,
+                    help='refreshes per second on top of the shared upstream rate limit, 0 for no extra cap')
+args = parser.parse_args()
+
+for progress in RefreshAllJob(capi_authorizer, args.force, args.workers, args.rate).run():
+    print(json.dumps(progress), flush=True)
@@ -0,0 +1,11 @@
+"""
+Runs background proactive token refresher.
+
+Started by uwsgi as a mule (see generate_uswgi_config.py), so exactly one refresher runs per deployment,
+can also be run standalone: python3 refresher.py
+"""
+
+from capi import capi_authorizer
+from capi.refresher import ProactiveRefresher
+
+ProactiveRefresher(capi_authorizer).run_forever()
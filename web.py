@@ -1,158 +1,525 @@
-import falcon
-import json
-import random
-
-import capi
-from capi import capi_authorizer
-import config
-from EDMCLogging import get_main_logger
-
-logger = get_main_logger()
-logger.propagate = False
-
-
-def check_secret(req: falcon.request.Request, resp: falcon.response.Response, resource, params) -> None:
-    header_secret = req.headers.get('AUTH')  # for legacy reasons
-
-    cookies_secret = req.get_cookie_values('key')
-
-    if header_secret != config.access_key:
-        if cookies_secret is None or cookies_secret[0] != config.access_key:
-            raise falcon.HTTPForbidden
-
-
-class AuthInit:
-    def on_get(self, req: falcon.request.Request, resp: falcon.response.Response) -> None:
-        resp.content_type = falcon.MEDIA_HTML
-        resp.text = config.REDIRECT_HTML_TEMPLATE.format(link=capi_authorizer.auth_init())
-
-
-class FDEVCallback:
-    def on_get(self, req: falcon.request.Request, resp: falcon.response.Response) -> None:
-        code = req.get_param('code')
-        state = req.get_param('state')
-        try:
-            msg = capi_authorizer.fdev_callback(code, state)
-            resp.content_type = falcon.MEDIA_JSON
-            resp.text = json.dumps(msg)
-
-        except KeyError as e:
-            logger.warning(f'Exception on FDEVCallback, code: {code!r}, state: {state!r}', exc_info=e)
-            raise falcon.HTTPNotFound(description=str(e))
-
-        except Exception as e:
-            logger.warning(f'Exception on FDEVCallback, code: {code!r}, state: {state!r}', exc_info=e)
-            raise falcon.HTTPBadRequest(description=str(e))
-
-
-class TokenByState:
-    def on_get(self, req: falcon.request.Request, resp: falcon.response.Response, state: str) -> None:
-        resp.content_type = falcon.MEDIA_JSON
-        tokens = capi_authorizer.get_token_by_state(state)
-        if tokens is None:
-            raise falcon.HTTPNotFound(description='No such state found')
-
-        resp.text = json.dumps(tokens)
-
-    def on_delete(self, req: falcon.request.Request, resp: falcon.response.Response, state: str):
-        tokens = capi_authorizer.get_token_by_state(state)
-        if tokens is None:
-            raise falcon.HTTPNotFound(description='No such state found')
-
-        capi_authorizer.delete_by_state(state)
-
-
-class TokenByNickname:
-    @falcon.before(check_secret)
-    def on_get(self, req: falcon.request.Request, resp: falcon.response.Response, nickname: str):
-        resp.content_type = falcon.MEDIA_JSON
-        state = capi_authorizer.model.get_state_by_nickname(nickname)
-        if state is None:
-            raise falcon.HTTPNotFound(description='No such nickname found')
-
-        tokens = capi_authorizer.get_token_by_state(state)
-
-        resp.text = json.dumps(tokens)
-
-    @falcon.before(check_secret)
-    def on_delete(self, req: falcon.request.Request, resp: falcon.response.Response, nickname: str):
-        state = capi_authorizer.model.get_state_by_nickname(nickname)
-        if state is None:
-            raise falcon.HTTPNotFound(description='No such nickname found')
-
-        capi_authorizer.delete_by_state(state)
-
-
-class TokenByFID:
-    NOT_FOUND_DESCRIPTION = 'No such FID was found'
-
-    @falcon.before(check_secret)
-    def on_get(self, req: falcon.request.Request, resp: falcon.response.Response, fid: str):
-        resp.content_type = falcon.MEDIA_JSON
-
-        state = capi_authorizer.model.get_state_by_fid(fid)
-        if state is None:
-            raise falcon.HTTPNotFound(description=self.NOT_FOUND_DESCRIPTION)
-
-        tokens = capi.capi_authorizer.get_token_by_state(state)
-        resp.text = json.dumps(tokens)
-
-    @falcon.before(check_secret)
-    def on_delete(self, req: falcon.request.Request, resp: falcon.response.Response, fid: str):
-        state = capi_authorizer.model.get_state_by_fid(fid)
-        if state is None:
-            raise falcon.HTTPNotFound(description=self.NOT_FOUND_DESCRIPTION)
-
-        capi_authorizer.delete_by_state(state)
-
-
-class CleanOrphanRecords:
-    def on_post(self, req: falcon.request.Request, resp: falcon.response.Response):
-        capi_authorizer.cleanup_orphans()
-
-
-class ListTokens:
-    @falcon.before(check_secret)
-    def on_get(self, req: falcon.request.Request, resp: falcon.response.Response):
-        resp.content_type = falcon.MEDIA_JSON
-        resp.text = json.dumps(capi_authorizer.list_all_valid_users())
-
-
-class RandomToken:
-    # for legacy reasons
-    @falcon.before(check_secret)
-    def on_get(self, req: falcon.request.Request, resp: falcon.response.Response):
-        resp.content_type = falcon.MEDIA_JSON
-
-        list_users = capi_authorizer.list_all_valid_users()
-
-        if len(list_users) == 0:
-            raise falcon.HTTPNotFound(description='No users in DB')
-
-        for attempt in range(0, 3):
-            random_user = random.choice(list_users)
-            random_user_tokens = capi_authorizer.get_token_by_state(random_user['state'])
-            if random_user_tokens is not None and 'access_token' in random_user_tokens:  # To be sure
-                break
-
-        else:
-            raise falcon.HTTPInternalServerError
-
-        # if random_user_tokens is None or 'access_token' not in random_user_tokens:
-
-        resp.text = json.dumps(random_user_tokens)
-
-
-application = falcon.App()
-application.add_route('/authorize', AuthInit())
-application.add_route('/fdev-redirect', FDEVCallback())
-application.add_route('/users/{state}', TokenByState())  # for legacy reasons
-application.add_route('/random_token', RandomToken())  # for legacy reasons, subject to decommissioning
-application.add_route('/users/by-state/{state}', TokenByState())
-application.add_route('/users/by-nickname/{nickname}', TokenByNickname())
-application.add_route('/users/by-fid/{fid}', TokenByFID())
-application.add_route('/users', ListTokens())
-application.add_route('/tools/clean-orphan-records', CleanOrphanRecords())
-
-if __name__ == '__main__':
-    waitress.serve(application, host='127.0.0.1', port=9000)
+import cProfile
+import falcon
+import hashlib
+import json
+import random
+import time
+from typing import Iterator, Union
+
+import capi
+from capi import capi_authorizer
+from capi import serializers
+from capi.metrics import metrics, AUTHORIZATIONS_ROWS, HTTP_REQUEST_SECONDS
+from capi.profiling import RouteProfiles, SORT_KEYS
+from capi.refresher import RefreshAllJob
+import config
+from EDMCLogging import get_main_logger
+
+try:
+    import uwsgidecorators  # only available under uwsgi
+
+except ImportError:
+    uwsgidecorators = None
+
+logger = get_main_logger()
+logger.propagate = False
+
+
+def has_secret(req: falcon.request.Request) -> bool:
+    header_secret = req.get_header('AUTH')  # for legacy reasons
+
+    cookies_secret = req.get_cookie_values('key')
+
+    if header_secret != config.access_key:
+        if cookies_secret is None or cookies_secret[0] != config.access_key:
+            return False
+
+    return True
+
+
+def check_secret(req: falcon.request.Request, resp: falcon.response.Response, resource, params) -> None:
+    if not has_secret(req):
+        raise falcon.HTTPForbidden
+
+
+def service_unavailable(e: capi.exceptions.UpstreamUnavailable) -> falcon.HTTPServiceUnavailable:
+    """
+    For users which exist, but have no valid token till FDEV is back, so clients don't take them for gone ones
+    """
+
+    return falcon.HTTPServiceUnavailable(description=e.message, retry_after=int(e.retry_after) + 1)
+
+
+def negotiate_serializer(req: falcon.request.Request) -> serializers.Serializer:
+    """
+    Serializer by Accept header, JSON if client accepts anything or nothing we support
+    """
+
+    return serializers.negotiate(req.get_header('Accept'))
+
+
+def set_serialized(req: falcon.request.Request, resp: falcon.response.Response, obj) -> None:
+    serializer = negotiate_serializer(req)
+    resp.content_type = serializer.content_type
+    resp.vary = ('Accept',)
+    resp.data = serializer.dumps(obj)
+
+
+class TokenCaching:
+    """
+    Cache-Control and ETag of token routes, token can be cached until it gets into config.token_refresh_margin.
+
+    ETag is derived from access token, it's weak as the body differs by Accept and by expires_over. Routes which are
+    behind the secret are marked private, so shared caches don't give them to whoever asks.
+    """
+
+    @staticmethod
+    def etag(token: dict) -> str:
+        return hashlib.blake2b(token['access_token'].encode('utf-8'), digest_size=16).hexdigest()
+
+    @classmethod
+    def set_headers(cls, resp: falcon.response.Response, token: dict, private: bool) -> None:
+        max_age = max(0, token['expires_on'] - config.token_refresh_margin - int(time.time()))
+        resp.cache_control = ['private', f'max-age={max_age}'] if private else [f'max-age={max_age}']
+        resp.etag = f'W/"{cls.etag(token)}"'
+        resp.vary = ('Accept',)
+
+    @classmethod
+    def not_modified(cls, req: falcon.request.Request, resp: falcon.response.Response, token: Union[dict, None],
+                     private: bool) -> bool:
+        """
+        Responds 304 if the client already has the token and it's still fresh
+
+        :param req:
+        :param resp:
+        :param token: result of capi_authorizer.peek_token_by_state, so usage isn't counted
+        :param private:
+        :return: True if 304 was set and nothing else has to be done
+        """
+
+        if token is None or req.if_none_match is None:
+            return False
+
+        etag = cls.etag(token)
+        if not any(tag == '*' or tag == etag for tag in req.if_none_match):
+            return False
+
+        resp.status = falcon.HTTP_NOT_MODIFIED
+        cls.set_headers(resp, token, private)
+        return True
+
+
+class MetricsMiddleware:
+    """
+    Measures requests by route template, works for both web.py and web_asgi.py
+    """
+
+    def process_request(self, req: falcon.request.Request, resp: falcon.response.Response) -> None:
+        req.context.started = time.perf_counter()
+
+    def process_response(self, req: falcon.request.Request, resp: falcon.response.Response, resource,
+                         req_succeeded: bool) -> None:
+        metrics.observe(
+            HTTP_REQUEST_SECONDS,
+            {'route': req.uri_template or 'unknown', 'method': req.method, 'status': str(resp.status)[:3]},
+            time.perf_counter() - req.context.started
+        )
+
+    async def process_request_async(self, req, resp) -> None:
+        self.process_request(req, resp)
+
+    async def process_response_async(self, req, resp, resource, req_succeeded: bool) -> None:
+        self.process_response(req, resp, resource, req_succeeded)
+
+
+class ProfilingMiddleware:
+    """
+    Profiles sampled requests and requests with config.profiling_header and the secret, WSGI only, as in ASGI
+    requests interleave in one thread.
+
+    It isn't added to the app at all unless config.profiling, so it costs nothing when disabled.
+    """
+
+    def __init__(self, profiles: RouteProfiles):
+        self.profiles = profiles
+
+    def process_request(self, req: falcon.request.Request, resp: falcon.response.Response) -> None:
+        if random.random() < config.profiling_sample_rate \
+                or (req.get_header(config.profiling_header) is not None and has_secret(req)):
+            req.context.profiler = cProfile.Profile()
+            req.context.profiler.enable()
+
+    def process_response(self, req: falcon.request.Request, resp: falcon.response.Response, resource,
+                         req_succeeded: bool) -> None:
+        profiler = req.context.get('profiler')
+        if profiler is not None:
+            profiler.disable()
+            self.profiles.add(req.uri_template or 'unknown', profiler)
+
+
+class AuthInit:
+    def on_get(self, req: falcon.request.Request, resp: falcon.response.Response) -> None:
+        resp.content_type = falcon.MEDIA_HTML
+        resp.text = config.REDIRECT_HTML_TEMPLATE.format(link=capi_authorizer.auth_init())
+
+
+class FDEVCallback:
+    def on_get(self, req: falcon.request.Request, resp: falcon.response.Response) -> None:
+        code = req.get_param('code')
+        state = req.get_param('state')
+        try:
+            msg = capi_authorizer.fdev_callback(code, state)
+            resp.content_type = falcon.MEDIA_JSON
+            resp.text = json.dumps(msg)
+
+        except capi.exceptions.UpstreamThrottled as e:
+            raise falcon.HTTPServiceUnavailable(description=str(e), retry_after=int(e.retry_after) + 1)
+
+        except KeyError as e:
+            logger.warning(f'Exception on FDEVCallback, code: {code!r}, state: {state!r}', exc_info=e)
+            raise falcon.HTTPNotFound(description=str(e))
+
+        except Exception as e:
+            logger.warning(f'Exception on FDEVCallback, code: {code!r}, state: {state!r}', exc_info=e)
+            raise falcon.HTTPBadRequest(description=str(e))
+
+
+class TokenByState:
+    def on_get(self, req: falcon.request.Request, resp: falcon.response.Response, state: str) -> None:
+        if req.if_none_match is not None and \
+                TokenCaching.not_modified(req, resp, capi_authorizer.peek_token_by_state(state), private=False):
+            return
+
+        try:
+            tokens = capi_authorizer.get_token_by_state(state)
+
+        except capi.exceptions.UpstreamUnavailable as e:
+            raise service_unavailable(e)
+
+        if tokens is None:
+            raise falcon.HTTPNotFound(description='No such state found')
+
+        TokenCaching.set_headers(resp, tokens, private=False)
+        set_serialized(req, resp, tokens)
+
+    def on_delete(self, req: falcon.request.Request, resp: falcon.response.Response, state: str):
+        try:
+            tokens = capi_authorizer.get_token_by_state(state)
+
+        except capi.exceptions.UpstreamUnavailable:
+            tokens = dict()  # the state exists, it's just FDEV which is unavailable
+
+        if tokens is None:
+            raise falcon.HTTPNotFound(description='No such state found')
+
+        capi_authorizer.delete_by_state(state)
+
+
+class TokenByNickname:
+    @falcon.before(check_secret)
+    def on_get(self, req: falcon.request.Request, resp: falcon.response.Response, nickname: str):
+        state = capi_authorizer.model.get_state_by_nickname(nickname)
+        if state is None:
+            raise falcon.HTTPNotFound(description='No such nickname found')
+
+        if req.if_none_match is not None and \
+                TokenCaching.not_modified(req, resp, capi_authorizer.peek_token_by_state(state), private=True):
+            return
+
+        try:
+            tokens = capi_authorizer.get_token_by_state(state)
+
+        except capi.exceptions.UpstreamUnavailable as e:
+            raise service_unavailable(e)
+
+        if tokens is not None:
+            TokenCaching.set_headers(resp, tokens, private=True)
+
+        set_serialized(req, resp, tokens)
+
+    @falcon.before(check_secret)
+    def on_delete(self, req: falcon.request.Request, resp: falcon.response.Response, nickname: str):
+        state = capi_authorizer.model.get_state_by_nickname(nickname)
+        if state is None:
+            raise falcon.HTTPNotFound(description='No such nickname found')
+
+        capi_authorizer.delete_by_state(state)
+
+
+class TokenByFID:
+    NOT_FOUND_DESCRIPTION = 'No such FID was found'
+
+    @falcon.before(check_secret)
+    def on_get(self, req: falcon.request.Request, resp: falcon.response.Response, fid: str):
+        state = capi_authorizer.model.get_state_by_fid(fid)
+        if state is None:
+            raise falcon.HTTPNotFound(description=self.NOT_FOUND_DESCRIPTION)
+
+        if req.if_none_match is not None and \
+                TokenCaching.not_modified(req, resp, capi_authorizer.peek_token_by_state(state), private=True):
+            return
+
+        try:
+            tokens = capi_authorizer.get_token_by_state(state)
+
+        except capi.exceptions.UpstreamUnavailable as e:
+            raise service_unavailable(e)
+
+        if tokens is not None:
+            TokenCaching.set_headers(resp, tokens, private=True)
+
+        set_serialized(req, resp, tokens)
+
+    @falcon.before(check_secret)
+    def on_delete(self, req: falcon.request.Request, resp: falcon.response.Response, fid: str):
+        state = capi_authorizer.model.get_state_by_fid(fid)
+        if state is None:
+            raise falcon.HTTPNotFound(description=self.NOT_FOUND_DESCRIPTION)
+
+        capi_authorizer.delete_by_state(state)
+
+
+class BulkTokens:
+    """
+    Tokens for many users by one request, body: {"fids": [...], "nicknames": [...], "states": [...]}, all keys are
+    optional. Response has the same keys with {value: token or null} mappings
+    """
+
+    RESOLVERS = {
+        'fids': lambda values: capi_authorizer.model.get_states_by_fids(values),
+        'nicknames': lambda values: capi_authorizer.model.get_states_by_nicknames(values),
+        'states': lambda values: capi_authorizer.model.get_existing_states(values)
+    }
+
+    @classmethod
+    def validate(cls, body) -> None:
+        if not isinstance(body, dict) or not set(body.keys()).issubset(cls.RESOLVERS.keys()):
+            raise falcon.HTTPBadRequest(description=f'Body must be an object with keys {list(cls.RESOLVERS.keys())}')
+
+        for values in body.values():
+            if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+                raise falcon.HTTPBadRequest(description='Values must be lists of strings')
+
+        if sum(len(values) for values in body.values()) > config.bulk_max_items:
+            raise falcon.HTTPBadRequest(description=f'No more than {config.bulk_max_items} items per request')
+
+    @classmethod
+    def resolve(cls, body: dict[str, list[str]]) -> dict[str, dict]:
+        """
+        :return: {key: {value: state or None}}
+        """
+        return {key: cls.RESOLVERS[key](values) for key, values in body.items() if len(values) > 0}
+
+    @staticmethod
+    def found_states(resolved: dict[str, dict]) -> list[str]:
+        return [state for states in resolved.values() for state in states.values() if state is not None]
+
+    @staticmethod
+    def tokens_response(resolved: dict[str, dict], tokens: dict[str, dict]) -> dict:
+        return {
+            key: {value: None if state is None else tokens.get(state) for value, state in states.items()}
+            for key, states in resolved.items()
+        }
+
+    @staticmethod
+    def deleted_response(resolved: dict[str, dict]) -> dict:
+        # {key: [values which were deleted]}
+        return {
+            key: [value for value, state in states.items() if state is not None] for key, states in resolved.items()
+        }
+
+    def _resolve(self, req: falcon.request.Request) -> dict[str, dict]:
+        body = req.get_media()
+        self.validate(body)
+        return self.resolve(body)
+
+    @falcon.before(check_secret)
+    def on_post(self, req: falcon.request.Request, resp: falcon.response.Response):
+        resolved = self._resolve(req)
+        tokens = capi_authorizer.get_tokens_by_states(self.found_states(resolved))
+        set_serialized(req, resp, self.tokens_response(resolved, tokens))
+
+    @falcon.before(check_secret)
+    def on_delete(self, req: falcon.request.Request, resp: falcon.response.Response):
+        resolved = self._resolve(req)
+        capi_authorizer.delete_by_states(self.found_states(resolved))
+        set_serialized(req, resp, self.deleted_response(resolved))
+
+
+class CleanOrphanRecords:
+    def on_post(self, req: falcon.request.Request, resp: falcon.response.Response):
+        capi_authorizer.cleanup_orphans()
+
+
+class RefreshAll:
+    """
+    Refreshes all valid tokens, ?force=true&workers=N&rate=R, streams progress as JSON lines, the last line is
+    the final summary
+    """
+
+    @staticmethod
+    def job(req) -> RefreshAllJob:
+        return RefreshAllJob(
+            capi_authorizer,
+            force_refresh=req.get_param_as_bool('force', default=False),
+            workers=req.get_param_as_int('workers', min_value=1, default=config.refresh_all_workers),
+            rate=req.get_param_as_float('rate', min_value=0, default=config.refresh_all_rate)
+        )
+
+    @staticmethod
+    def _stream(job: RefreshAllJob) -> Iterator[bytes]:
+        for progress in job.run():
+            yield json.dumps(progress).encode('utf-8') + b'\n'
+
+    @falcon.before(check_secret)
+    def on_post(self, req: falcon.request.Request, resp: falcon.response.Response):
+        resp.content_type = 'application/x-ndjson'
+        resp.stream = self._stream(self.job(req))
+
+
+class PrometheusMetrics:
+    """
+    Metrics of all processes in Prometheus text format, without secret as Prometheus can't send it,
+    there is nothing sensitive here
+    """
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    @staticmethod
+    def render() -> str:
+        return metrics.render({AUTHORIZATIONS_ROWS: capi_authorizer.model.count_records()})
+
+    def on_get(self, req: falcon.request.Request, resp: falcon.response.Response):
+        resp.content_type = self.CONTENT_TYPE
+        resp.text = self.render()
+
+
+class Profiles:
+    """
+    Without params lists profiled routes, ?route=<route template>&top=N&sort=cumulative|tottime|calls gives
+    top functions of the route's profile
+    """
+
+    @falcon.before(check_secret)
+    def on_get(self, req: falcon.request.Request, resp: falcon.response.Response):
+        route = req.get_param('route')
+        if route is None:
+            resp.content_type = falcon.MEDIA_JSON
+            resp.text = json.dumps(route_profiles.routes())
+            return
+
+        sort = req.get_param('sort', default='cumulative')
+        if sort not in SORT_KEYS:
+            raise falcon.HTTPBadRequest(description=f'sort must be one of {SORT_KEYS}')
+
+        summary = route_profiles.summary(route, top=req.get_param_as_int('top', min_value=1, default=30), sort=sort)
+        if summary == '':
+            raise falcon.HTTPNotFound(description='No profiles for this route')
+
+        resp.content_type = falcon.MEDIA_TEXT
+        resp.text = summary
+
+
+class CacheStats:
+    @falcon.before(check_secret)
+    def on_get(self, req: falcon.request.Request, resp: falcon.response.Response):
+        resp.content_type = falcon.MEDIA_JSON
+        resp.text = json.dumps(capi_authorizer.model.cache.stats())
+
+
+class ListTokens:
+    """
+    Streams valid users, supports keyset pagination: ?after=<state>&limit=N, next page's `after` is in
+    Next-After header (absent if the page isn't full), and fields selection: ?fields=fid,nickname
+
+    JSON is streamed as an array, MessagePack as concatenated maps, as array header needs length upfront
+    """
+
+    FIELDS = ('nickname', 'fid', 'state')
+
+    @staticmethod
+    def _stream(users, serializer: serializers.Serializer) -> Iterator[bytes]:
+        opening, separator, closing = serializer.list_framing or (b'', b'', b'')
+        yield opening
+        next_separator = b''
+        for user in users:
+            yield next_separator + serializer.dumps(user)
+            next_separator = separator
+
+        yield closing
+
+    @classmethod
+    def parse_params(cls, req: falcon.request.Request) -> tuple[list[str], str, int]:
+        """
+        :return: fields, after, limit
+        """
+        # falcon doesn't split comma separated values unless auto_parse_qs_csv
+        values = req.get_param_as_list('fields', default=list(cls.FIELDS))
+        fields = [field for value in values for field in value.split(',') if field]
+        if len(fields) == 0 or not set(fields).issubset(cls.FIELDS):
+            raise falcon.HTTPBadRequest(description=f'fields must be some of {cls.FIELDS}')
+
+        after = req.get_param('after', default='')
+        limit = req.get_param_as_int('limit', min_value=1, default=-1)
+        return fields, after, limit
+
+    @falcon.before(check_secret)
+    def on_get(self, req: falcon.request.Request, resp: falcon.response.Response):
+        fields, after, limit = self.parse_params(req)
+
+        if limit != -1:
+            next_after = capi_authorizer.model.get_valid_page_last_state(after, limit)
+            if next_after is not None:
+                resp.set_header('Next-After', next_after)
+
+        serializer = negotiate_serializer(req)
+        resp.content_type = serializer.content_type
+        resp.vary = ('Accept',)
+        resp.stream = self._stream(capi_authorizer.iter_valid_users(fields, after, limit), serializer)
+
+
+class RandomToken:
+    # for legacy reasons
+    @falcon.before(check_secret)
+    def on_get(self, req: falcon.request.Request, resp: falcon.response.Response):
+        if len(capi_authorizer.model.random_index) == 0:
+            raise falcon.HTTPNotFound(description='No users in DB')
+
+        random_user_tokens = capi_authorizer.get_random_token(
+            least_used=req.get_param_as_bool('least_used', default=False)
+        )
+
+        if random_user_tokens is None:
+            raise falcon.HTTPInternalServerError
+
+        set_serialized(req, resp, random_user_tokens)
+
+
+route_profiles = RouteProfiles(config.profiling_dir, config.profiling_dump_interval)
+
+middleware = [MetricsMiddleware()]
+if config.profiling:
+    middleware.append(ProfilingMiddleware(route_profiles))
+
+application = falcon.App(middleware=middleware)
+application.add_route('/authorize', AuthInit())
+application.add_route('/fdev-redirect', FDEVCallback())
+application.add_route('/users/{state}', TokenByState())  # for legacy reasons
+application.add_route('/random_token', RandomToken())  # for legacy reasons, subject to decommissioning
+application.add_route('/users/by-state/{state}', TokenByState())
+application.add_route('/users/by-nickname/{nickname}', TokenByNickname())
+application.add_route('/users/by-fid/{fid}', TokenByFID())
+application.add_route('/users', ListTokens())
+application.add_route('/users/bulk', BulkTokens())
+application.add_route('/tools/clean-orphan-records', CleanOrphanRecords())
+application.add_route('/tools/cache-stats', CacheStats())
+application.add_route('/tools/refresh-all', RefreshAll())
+application.add_route('/metrics', PrometheusMetrics())
+application.add_route('/tools/profiles', Profiles())
+
+if uwsgidecorators is not None:
+    # open the DB in every worker right after fork instead of on its first request
+    uwsgidecorators.postfork(capi_authorizer.get)
+
+if __name__ == '__main__':
+    waitress.serve(application, host='127.0.0.1', port=9000)
@@ -0,0 +1,292 @@
+"""
+ASGI counterpart of web.py with the same routes, run it with any ASGI server, e.g.:
+    uvicorn web_asgi:application
+
+Refreshes don't block, SQLite work goes to a small thread pool, see capi/aio.py
+"""
+
+import json
+from typing import AsyncIterator
+
+import falcon
+import falcon.asgi
+
+import config
+import web
+from capi import capi_authorizer
+from capi import exceptions
+from capi import serializers
+from capi.aio import AsyncCAPIAuthorizer
+from EDMCLogging import get_main_logger
+
+logger = get_main_logger()
+
+aio_authorizer = AsyncCAPIAuthorizer(capi_authorizer)
+
+
+async def check_secret(req: falcon.asgi.Request, resp: falcon.asgi.Response, resource, params) -> None:
+    web.check_secret(req, resp, resource, params)
+
+
+class AuthInit:
+    async def on_get(self, req: falcon.asgi.Request, resp: falcon.asgi.Response) -> None:
+        resp.content_type = falcon.MEDIA_HTML
+        resp.text = config.REDIRECT_HTML_TEMPLATE.format(link=await aio_authorizer.run_db(capi_authorizer.auth_init))
+
+
+class FDEVCallback:
+    async def on_get(self, req: falcon.asgi.Request, resp: falcon.asgi.Response) -> None:
+        code = req.get_param('code')
+        state = req.get_param('state')
+        try:
+            # logins are rare, so it's fine to do it in blocking way in thread pool
+            msg = await aio_authorizer.run_blocking(capi_authorizer.fdev_callback, code, state)
+            resp.content_type = falcon.MEDIA_JSON
+            resp.text = json.dumps(msg)
+
+        except exceptions.UpstreamThrottled as e:
+            raise falcon.HTTPServiceUnavailable(description=str(e), retry_after=int(e.retry_after) + 1)
+
+        except KeyError as e:
+            logger.warning(f'Exception on FDEVCallback, code: {code!r}, state: {state!r}', exc_info=e)
+            raise falcon.HTTPNotFound(description=str(e))
+
+        except Exception as e:
+            logger.warning(f'Exception on FDEVCallback, code: {code!r}, state: {state!r}', exc_info=e)
+            raise falcon.HTTPBadRequest(description=str(e))
+
+
+class TokenByState:
+    async def on_get(self, req: falcon.asgi.Request, resp: falcon.asgi.Response, state: str) -> None:
+        if req.if_none_match is not None and web.TokenCaching.not_modified(
+                req, resp, await aio_authorizer.run_db(capi_authorizer.peek_token_by_state, state), private=False):
+            return
+
+        try:
+            tokens = await aio_authorizer.get_token_by_state(state)
+
+        except exceptions.UpstreamUnavailable as e:
+            raise web.service_unavailable(e)
+
+        if tokens is None:
+            raise falcon.HTTPNotFound(description='No such state found')
+
+        web.TokenCaching.set_headers(resp, tokens, private=False)
+        web.set_serialized(req, resp, tokens)
+
+    async def on_delete(self, req: falcon.asgi.Request, resp: falcon.asgi.Response, state: str):
+        try:
+            tokens = await aio_authorizer.get_token_by_state(state)
+
+        except exceptions.UpstreamUnavailable:
+            tokens = dict()  # see web.TokenByState.on_delete
+
+        if tokens is None:
+            raise falcon.HTTPNotFound(description='No such state found')
+
+        await aio_authorizer.run_db(capi_authorizer.delete_by_state, state)
+
+
+class TokenByNickname:
+    @falcon.before(check_secret)
+    async def on_get(self, req: falcon.asgi.Request, resp: falcon.asgi.Response, nickname: str):
+        state = await aio_authorizer.run_db(capi_authorizer.model.get_state_by_nickname, nickname)
+        if state is None:
+            raise falcon.HTTPNotFound(description='No such nickname found')
+
+        if req.if_none_match is not None and web.TokenCaching.not_modified(
+                req, resp, await aio_authorizer.run_db(capi_authorizer.peek_token_by_state, state), private=True):
+            return
+
+        try:
+            tokens = await aio_authorizer.get_token_by_state(state)
+
+        except exceptions.UpstreamUnavailable as e:
+            raise web.service_unavailable(e)
+
+        if tokens is not None:
+            web.TokenCaching.set_headers(resp, tokens, private=True)
+
+        web.set_serialized(req, resp, tokens)
+
+    @falcon.before(check_secret)
+    async def on_delete(self, req: falcon.asgi.Request, resp: falcon.asgi.Response, nickname: str):
+        state = await aio_authorizer.run_db(capi_authorizer.model.get_state_by_nickname, nickname)
+        if state is None:
+            raise falcon.HTTPNotFound(description='No such nickname found')
+
+        await aio_authorizer.run_db(capi_authorizer.delete_by_state, state)
+
+
+class TokenByFID:
+    NOT_FOUND_DESCRIPTION = web.TokenByFID.NOT_FOUND_DESCRIPTION
+
+    @falcon.before(check_secret)
+    async def on_get(self, req: falcon.asgi.Request, resp: falcon.asgi.Response, fid: str):
+        state = await aio_authorizer.run_db(capi_authorizer.model.get_state_by_fid, fid)
+        if state is None:
+            raise falcon.HTTPNotFound(description=self.NOT_FOUND_DESCRIPTION)
+
+        if req.if_none_match is not None and web.TokenCaching.not_modified(
+                req, resp, await aio_authorizer.run_db(capi_authorizer.peek_token_by_state, state), private=True):
+            return
+
+        try:
+            tokens = await aio_authorizer.get_token_by_state(state)
+
+        except exceptions.UpstreamUnavailable as e:
+            raise web.service_unavailable(e)
+
+        if tokens is not None:
+            web.TokenCaching.set_headers(resp, tokens, private=True)
+
+        web.set_serialized(req, resp, tokens)
+
+    @falcon.before(check_secret)
+    async def on_delete(self, req: falcon.asgi.Request, resp: falcon.asgi.Response, fid: str):
+        state = await aio_authorizer.run_db(capi_authorizer.model.get_state_by_fid, fid)
+        if state is None:
+            raise falcon.HTTPNotFound(description=self.NOT_FOUND_DESCRIPTION)
+
+        await aio_authorizer.run_db(capi_authorizer.delete_by_state, state)
+
+
+class BulkTokens:
+    async def _resolve(self, req: falcon.asgi.Request) -> dict[str, dict]:
+        body = await req.get_media()
+        web.BulkTokens.validate(body)
+        return await aio_authorizer.run_db(web.BulkTokens.resolve, body)
+
+    @falcon.before(check_secret)
+    async def on_post(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        resolved = await self._resolve(req)
+        tokens = await aio_authorizer.get_tokens_by_states(web.BulkTokens.found_states(resolved))
+        web.set_serialized(req, resp, web.BulkTokens.tokens_response(resolved, tokens))
+
+    @falcon.before(check_secret)
+    async def on_delete(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        resolved = await self._resolve(req)
+        await aio_authorizer.run_db(capi_authorizer.delete_by_states, web.BulkTokens.found_states(resolved))
+        web.set_serialized(req, resp, web.BulkTokens.deleted_response(resolved))
+
+
+class CleanOrphanRecords:
+    async def on_post(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        await aio_authorizer.run_db(capi_authorizer.cleanup_orphans)
+
+
+class RefreshAll:
+    """
+    See web.RefreshAll
+    """
+
+    @staticmethod
+    async def _stream(job) -> AsyncIterator[bytes]:
+        progress_iterator = job.run()
+        while (progress := await aio_authorizer.run_blocking(next, progress_iterator, None)) is not None:
+            yield json.dumps(progress).encode('utf-8') + b'\n'
+
+    @falcon.before(check_secret)
+    async def on_post(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        resp.content_type = 'application/x-ndjson'
+        resp.stream = self._stream(web.RefreshAll.job(req))
+
+
+class PrometheusMetrics:
+    async def on_get(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        resp.content_type = web.PrometheusMetrics.CONTENT_TYPE
+        resp.text = await aio_authorizer.run_db(web.PrometheusMetrics.render)
+
+
+class CacheStats:
+    @falcon.before(check_secret)
+    async def on_get(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        resp.content_type = falcon.MEDIA_JSON
+        resp.text = json.dumps(capi_authorizer.model.cache.stats())
+
+
+class ListTokens:
+    """
+    See web.ListTokens, cursor can't be shared across threads of the pool, so we stream by chunks
+    """
+
+    CHUNK_SIZE = 1000
+
+    @staticmethod
+    def _fetch_chunk(fields: list[str], after: str, limit: int) -> list[dict]:
+        return list(capi_authorizer.iter_valid_users(fields, after, limit))
+
+    async def _stream(self, fields: list[str], after: str, limit: int,
+                      serializer: serializers.Serializer) -> AsyncIterator[bytes]:
+        # state is needed to fetch next chunk
+        select_fields = fields if 'state' in fields else fields + ['state']
+        left = limit
+        opening, separator, closing = serializer.list_framing or (b'', b'', b'')
+        yield opening
+        next_separator = b''
+        while left != 0:
+            chunk_size = self.CHUNK_SIZE if left == -1 else min(left, self.CHUNK_SIZE)
+            users = await aio_authorizer.run_db(self._fetch_chunk, select_fields, after, chunk_size)
+
+            for user in users:
+                after = user['state']
+                if select_fields is not fields:
+                    del user['state']
+
+                yield next_separator + serializer.dumps(user)
+                next_separator = separator
+
+            if len(users) < chunk_size:
+                break
+
+            if left != -1:
+                left -= len(users)
+
+        yield closing
+
+    @falcon.before(check_secret)
+    async def on_get(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        fields, after, limit = web.ListTokens.parse_params(req)
+
+        if limit != -1:
+            next_after = await aio_authorizer.run_db(capi_authorizer.model.get_valid_page_last_state, after, limit)
+            if next_after is not None:
+                resp.set_header('Next-After', next_after)
+
+        serializer = web.negotiate_serializer(req)
+        resp.content_type = serializer.content_type
+        resp.vary = ('Accept',)
+        resp.stream = self._stream(fields, after, limit, serializer)
+
+
+class RandomToken:
+    # for legacy reasons
+    @falcon.before(check_secret)
+    async def on_get(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):
+        if await aio_authorizer.run_db(len, capi_authorizer.model.random_index) == 0:
+            raise falcon.HTTPNotFound(description='No users in DB')
+
+        random_user_tokens = await aio_authorizer.get_random_token(
+            least_used=req.get_param_as_bool('least_used', default=False)
+        )
+
+        if random_user_tokens is None:
+            raise falcon.HTTPInternalServerError
+
+        web.set_serialized(req, resp, random_user_tokens)
+
+
+application = falcon.asgi.App(middleware=[web.MetricsMiddleware()])
+application.add_route('/authorize', AuthInit())
+application.add_route('/fdev-redirect', FDEVCallback())
+application.add_route('/users/{state}', TokenByState())  # for legacy reasons
+application.add_route('/random_token', RandomToken())  # for legacy reasons, subject to decommissioning
+application.add_route('/users/by-state/{state}', TokenByState())
+application.add_route('/users/by-nickname/{nickname}', TokenByNickname())
+application.add_route('/users/by-fid/{fid}', TokenByFID())
+application.add_route('/users', ListTokens())
+application.add_route('/users/bulk', BulkTokens())
+application.add_route('/tools/clean-orphan-records', CleanOrphanRecords())
+application.add_route('/tools/cache-stats', CacheStats())
+application.add_route('/tools/refresh-all', RefreshAll())
+application.add_route('/metrics', PrometheusMetrics())